@@ -1,9 +1,9 @@
-import bisect
 import random
 
 import matplotlib.pyplot as plt
 
 from gui.utils_gui import find_minimal_distance_to_separatrix, find_nearest
+from utils.diagnostic_utils import FeTable
 from utils.write_files import write_distance
 
 
@@ -104,28 +104,30 @@ def draw_ir_camera(shot_num: str, ir_data: dict, ax):
     ax.plot(ir_data["radii"], [0 for _ in range(len(ir_data["radii"]))], label=shot_num)
 
 
-def draw_expected(fe_data: dict, ax, phe_data: list, timestamp, add_flag: bool = False):
+def draw_expected(
+    fe_data: FeTable,
+    ax,
+    phe_data: list,
+    timestamp,
+    add_flag: bool = False,
+    te_preview: float = None,
+):
     """
 
-    :param fe_data:
+    :param fe_data: FeTable полихроматора
     :param ax:
     :param phe_data: list of number of phe for each channel
     :param add_flag:
+    :param te_preview: оценка Te по всем отношениям каналов, Polychromator.get_temperature_preview
     :return:
     """
 
     if not add_flag:
         ax.clear()
 
-    all_channels = {f"{idx_ch + 1}": [] for idx_ch in range(len(fe_data["1.0"]))}
-    Te_grid = fe_data["Te_grid"]
-    for index, f_e in enumerate(fe_data.values()):
-        if index > 1:
-            for idx_ch, value in enumerate(f_e):
-                all_channels[f"{idx_ch + 1}"].append(value)
-
-    ch1_to_ch2 = [ch1 / ch2 for ch1, ch2 in zip(all_channels["1"], all_channels["2"])]
-    ch1_to_ch3 = [ch1 / ch3 for ch1, ch3 in zip(all_channels["1"], all_channels["3"])]
+    Te_grid = fe_data.te_grid
+    ch1_to_ch2 = fe_data.fe[:, 0] / fe_data.fe[:, 1]
+    ch1_to_ch3 = fe_data.fe[:, 0] / fe_data.fe[:, 2]
 
     phe1_to_phe2 = phe_data[0] / phe_data[1]
     phe1_to_phe3 = phe_data[0] / phe_data[2]
@@ -139,6 +141,14 @@ def draw_expected(fe_data: dict, ax, phe_data: list, timestamp, add_flag: bool =
     ax.plot(Te_grid, ch1_to_ch2, label="ch1_exp / ch2_exp")
     ax.plot(Te_grid, ch1_to_ch3, label="ch1_exp / ch3_exp")
 
+    if te_preview is not None:
+        ax.axvline(
+            te_preview,
+            linestyle="--",
+            color="gray",
+            label=f"ratio Te {te_preview:.1f}, {timestamp}",
+        )
+
     ax.set_xlim([0, 150])
     ax.set_ylim([0, 20])
     ax.legend()
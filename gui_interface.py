@@ -147,13 +147,19 @@ class RawSignalsTab(ttk.Frame):
 
                 phe_data = fiber.get_signal_integrals()[0][timestamp_ind]
                 fe_data = fiber.fe_data
+                te_preview = float(fiber.get_temperature_preview(phe_data))
 
         draw_raw_signals(
             z_pos, float(timestamp), raw_data_plot, self.axs, add_flag=add_flag
         )
         draw_phe(z_pos, float(timestamp), phe_data, self.axs[0][1], add_flag=add_flag)
         draw_expected(
-            fe_data, self.axs[1][1], phe_data, float(timestamp), add_flag=add_flag
+            fe_data,
+            self.axs[1][1],
+            phe_data,
+            float(timestamp),
+            add_flag=add_flag,
+            te_preview=te_preview,
         )
 
         self.canvas.draw_idle()
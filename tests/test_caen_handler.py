@@ -0,0 +1,68 @@
+from unittest import mock
+
+import msgpack
+import numpy as np
+import pytest
+
+import utils.caen_handler as caen_handler
+
+
+@pytest.fixture
+def discharge(tmp_path):
+    """
+    Разряд из четырех файлов каенов по 5 выстрелов, 16 каналов по 1024 отсчета
+    """
+    rng = np.random.default_rng(4)
+    for msg_num in range(4):
+        shots = []
+        for shot in range(5):
+            channels = rng.integers(0, 1000, size=(16, 1024))
+            channels[0, rng.integers(300, 700)] = 5000
+            shots.append({"t": 10.0 * shot + 0.1 * msg_num, "ch": channels.tolist()})
+        with open(tmp_path / f"{msg_num}.msgpk", "wb") as msg_file:
+            msgpack.pack(shots, msg_file)
+    return tmp_path.parent, tmp_path.name
+
+
+def assert_same_caens(cached: dict, decoded: dict):
+    assert cached["combiscope_times"] == decoded["combiscope_times"]
+    for cached_caen, decoded_caen in zip(cached["caens_data"], decoded["caens_data"]):
+        assert cached_caen["caen_num"] == decoded_caen["caen_num"]
+        assert list(cached_caen["channels"]) == list(decoded_caen["channels"])
+        np.testing.assert_array_equal(
+            cached_caen["caen_channels"], decoded_caen["caen_channels"]
+        )
+        np.testing.assert_array_equal(
+            cached_caen["shots_time"].max_positions,
+            decoded_caen["shots_time"].max_positions,
+        )
+
+
+@pytest.mark.parametrize("processed_shots", [3, 30, "all"])
+def test_decoded_cache_round_trip(discharge, processed_shots):
+    path, discharge_num = discharge
+    channels = {msg_num: [1, 2, 5] for msg_num in range(4)}
+    decoded = caen_handler.handle_all_caens_cached(
+        discharge_num, path, processed_shots, multiprocess=False, channels=channels
+    )
+
+    # второй вызов не расшифровывает файлы заново
+    with mock.patch.object(caen_handler, "handle_all_caens") as handle:
+        cached = caen_handler.handle_all_caens_cached(
+            discharge_num, path, processed_shots, multiprocess=False, channels=channels
+        )
+    handle.assert_not_called()
+    assert_same_caens(cached, decoded)
+
+
+def test_decoded_cache_invalidated_by_source_change(discharge):
+    path, discharge_num = discharge
+    caen_handler.handle_all_caens_cached(discharge_num, path, 3, multiprocess=False)
+
+    with open(path / discharge_num / "2.msgpk", "ab") as msg_file:
+        msg_file.write(b"\x00")
+    with mock.patch.object(
+        caen_handler, "handle_all_caens", wraps=caen_handler.handle_all_caens
+    ) as handle:
+        caen_handler.handle_all_caens_cached(discharge_num, path, 3, multiprocess=False)
+    handle.assert_called_once()
@@ -0,0 +1,107 @@
+import bisect
+import statistics
+
+import numpy as np
+import pytest
+
+from utils.caen_handler import CaenTimeBase
+from utils.signal_processing import (WaveformIndex, get_signal_windows,
+                                     integrate_signals)
+
+
+def loop_integrals(
+    times, signals, config, all_const, t_step=0.325, noise_len=400, excess=3
+):
+    """
+    Прежний расчет Polychromator.get_signal_integrals: выстрел за выстрелом,
+    канал за каналом, bisect по полной оси времени и statistics на списках
+    """
+    all_shots_signal = []
+    all_shots_noise = []
+    for shot in range(len(times)):
+        all_ch_signal = []
+        all_ch_noise = []
+        for poly_ch, ch_config in enumerate(config):
+            signal = list(signals[shot][poly_ch])
+            signal_ind = [
+                bisect.bisect_left(times[shot], ch_config["sig_LeftBord"]),
+                bisect.bisect_right(times[shot], ch_config["sig_RightBord"]),
+            ]
+            signal_lvl = statistics.median(signal[:noise_len])
+            lvl_integral = signal_lvl * (
+                ch_config["sig_RightBord"] - ch_config["sig_LeftBord"]
+            )
+            signal_integral = (
+                sum(signal[signal_ind[0] : signal_ind[1]]) * t_step - lvl_integral
+            )
+            phe_number = signal_integral * all_const
+            noise_track = (
+                statistics.stdev(signal[:noise_len])
+                * all_const
+                * t_step
+                * (signal_ind[1] - signal_ind[0])
+            ) ** 2
+            if phe_number > 0:
+                noise_excess = phe_number * excess
+            else:
+                phe_number = 1
+                noise_excess = 0
+            all_ch_signal.append(phe_number)
+            all_ch_noise.append((noise_track + noise_excess) ** 0.5)
+        all_shots_signal.append(all_ch_signal)
+        all_shots_noise.append(all_ch_noise)
+    return np.array(all_shots_signal), np.array(all_shots_noise)
+
+
+@pytest.fixture
+def time_base():
+    rng = np.random.default_rng(1)
+    return CaenTimeBase(rng.integers(300, 700, size=20))
+
+
+def test_window_indices_match_bisect(time_base):
+    rng = np.random.default_rng(2)
+    axes = [list(time_base[shot]) for shot in range(len(time_base))]
+    # границы на отсчетах сетки, между ними и за краями оси
+    borders = np.concatenate(
+        [
+            rng.uniform(-200, 250, size=50),
+            axes[0][::97],
+            [axes[0][0] - 1, axes[0][-1] + 1],
+        ]
+    )
+    for border in borders:
+        left_ind, right_ind = time_base.window_indices(border, border)
+        assert left_ind.tolist() == [bisect.bisect_left(ax, border) for ax in axes]
+        assert right_ind.tolist() == [bisect.bisect_right(ax, border) for ax in axes]
+
+
+def test_integrate_signals_match_loop(time_base):
+    rng = np.random.default_rng(3)
+    shots, channels = len(time_base), 4
+    signals = rng.normal(50, 3, size=(shots, channels, 1024))
+    signals[:, :, 500:560] += rng.uniform(-5, 40, size=(shots, channels, 1))
+    config = [
+        {"sig_LeftBord": 40.0 + 2 * ch, "sig_RightBord": 60.5 + 3 * ch}
+        for ch in range(channels)
+    ]
+    all_const = 2.3
+
+    expected_phe, expected_noise = loop_integrals(
+        [list(time_base[shot]) for shot in range(shots)],
+        signals.tolist(),
+        config,
+        all_const,
+    )
+    left_ind, right_ind, borders = get_signal_windows(time_base, config)
+    for waveform_index in (None, WaveformIndex(signals)):
+        phe, noise = integrate_signals(
+            signals,
+            left_ind,
+            right_ind,
+            borders,
+            all_const,
+            waveform_index=waveform_index,
+        )
+        np.testing.assert_allclose(phe, expected_phe, rtol=1e-12, atol=1e-9)
+        np.testing.assert_allclose(noise, expected_noise, rtol=1e-12)
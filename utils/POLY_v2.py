@@ -1,15 +1,57 @@
-import bisect
 import json
-import math
+import multiprocessing as mp
 import os.path
-import statistics
 from pathlib import Path
 
 import matplotlib.pyplot as plt
-
-from utils.caen_handler import handle_all_caens, handle_all_caens_multiproces
-from utils.diagnostic_utils import (ExpectedFe, Gains_T15_34, Gains_T15_35,
-                                    GainsEquator, LaserNdYag)
+import numpy as np
+
+from utils.caen_handler import (CaenTimeBase, get_caen_channels,
+                                get_used_caen_channels, handle_all_caens,
+                                handle_all_caens_cached,
+                                handle_all_caens_multiproces)
+from utils.diagnostic_utils import (ExpectedFe, FeTable, Gains_T15_34,
+                                    Gains_T15_35, GainsEquator, LaserNdYag)
+from utils.fitting import (ERROR_OK, RatioIndex, fit_temperature,
+                           fit_temperature_window, get_chi_squared,
+                           get_fisher_errors, interpolate_response,
+                           monte_carlo_chunk, refine_temperature)
+from utils.signal_processing import (WaveformIndex, get_noise_statistics,
+                                     get_signal_windows, get_window_borders,
+                                     integrate_signals)
+
+
+class FiberResults:
+    """
+    Результаты волокна по выстрелам числами, строки только при записи в файл.
+    valid - выстрелы, для которых посчитаны и конечны Te, ne и обе ошибки,
+    error_flags - причина отказа в расчете ошибок, ERROR_* из utils.fitting
+    """
+
+    def __init__(self, te: np.ndarray):
+        self.te = np.asarray(te, dtype=float)
+        self.ne = np.full(self.te.shape, np.nan)
+        self.te_err = np.full(self.te.shape, np.nan)
+        self.ne_err = np.full(self.te.shape, np.nan)
+        self.error_flags = np.full(self.te.shape, ERROR_OK)
+        self.valid = np.zeros(self.te.shape, dtype=bool)
+
+        # интервалы Монте-Карло (shots, 2), см. get_fibers_monte_carlo
+        self.te_interval = np.full(self.te.shape + (2,), np.nan)
+        self.ne_interval = np.full(self.te.shape + (2,), np.nan)
+
+    def __len__(self):
+        return self.te.size
+
+    def set_errors(self, te_err: np.ndarray, ne_err: np.ndarray, flags: np.ndarray):
+        self.te_err, self.ne_err, self.error_flags = te_err, ne_err, flags
+        self.valid = (
+            (flags == ERROR_OK)
+            & np.isfinite(self.te)
+            & np.isfinite(self.ne)
+            & np.isfinite(self.te_err)
+            & np.isfinite(self.ne_err)
+        )
 
 
 class Polychromator:
@@ -18,20 +60,20 @@ class Polychromator:
         poly_name: int | str,
         fiber_number: int,
         z_cm: float,
-        caen_time: list,
-        caen_data: list,
+        caen_time: CaenTimeBase | list,
+        caen_data: list | np.ndarray,
         config_connection=None,
         gains: GainsEquator | Gains_T15_34 | Gains_T15_35 = None,
         laser: LaserNdYag = None,
         absolut_calib: Path = None,
         spectral_calib: Path = None,
-        fe_expected: dict = None,
+        fe_expected: FeTable = None,
     ):
         """
         :param poly_name: номер полихроматора в стойке!
         :param fiber_number: номер волокна, 1 - вверх
-        :param caen_time: приведенные по максимуму времена
-        :param caen_data: данные с каена, 5 каналов
+        :param caen_time: приведенные по максимуму времена, CaenTimeBase или списки осей
+        :param caen_data: данные с каена, 5 каналов, [ch][shot] или массив (shots, ch, 1024)
         :param config_connection: конфиг
         :param absolut_calib:
         """
@@ -40,15 +82,16 @@ class Polychromator:
         self.fiber_number = fiber_number
         self.z_cm = z_cm
 
+        self.waveform_index = None
+        self.noise_statistics = None
         self.signals = caen_data
+        if not isinstance(caen_time, CaenTimeBase):
+            caen_time = CaenTimeBase.from_axes(caen_time)
         self.signals_time = caen_time
         self.ch_number = len(self.signals)
         self.gain = gains
         self.laser = laser
 
-        self.signals_integrals = None
-        self.signals_noise_integrals = None
-
         self.fe_data = fe_expected
         self.expected_data = None
         self.config = config_connection
@@ -59,11 +102,104 @@ class Polychromator:
         self.load_spectral_calibration(spectral_calib_path=spectral_calib)
         self.load_absolut_calibration(absolut_calib_path=absolut_calib)
 
-        self.temperatures = []
-        self.density = []
+        self.results = None
+
+    @property
+    def signals(self):
+        return self._signals
+
+    @signals.setter
+    def signals(self, caen_data):
+        """
+        Новые сырые данные сбрасывают индекс сумм, статистику шума и phe
+        """
+        if isinstance(caen_data, np.ndarray):
+            # (shots, ch, 1024) -> (ch, shots, 1024), без копирования
+            caen_data = caen_data.swapaxes(0, 1)
+        self._signals = caen_data
+        self.waveform_index = None
+        self.noise_statistics = None
+        self.signals_integrals = None
+        self.signals_noise_integrals = None
+
+    @property
+    def config(self):
+        return self._config
+
+    @config.setter
+    def config(self, config_connection):
+        """
+        Новый конфиг каналов (окна интегрирования) сбрасывает phe
+        """
+        self._config = config_connection
+        self.signals_integrals = None
+        self.signals_noise_integrals = None
+
+    @property
+    def signals_integrals(self):
+        return self._signals_integrals
+
+    @signals_integrals.setter
+    def signals_integrals(self, phe):
+        """
+        Вместе с phe запоминаются окна интегрирования, по которым они посчитаны
+        """
+        self._signals_integrals = phe
+        self.integrals_borders = None
+        if phe is not None:
+            self.integrals_borders = get_window_borders(self.config[: self.ch_number])
+
+    def integrals_outdated(self) -> bool:
+        """
+        phe нет или окна в config поменялись после их расчета
+        """
+        return self.signals_integrals is None or not np.array_equal(
+            self.integrals_borders, get_window_borders(self.config[: self.ch_number])
+        )
+
+    @property
+    def fe_data(self) -> FeTable:
+        return self._fe_data
+
+    @fe_data.setter
+    def fe_data(self, fe_expected: FeTable):
+        """
+        Новая таблица fe сбрасывает матрицу ожидаемых сигналов
+        """
+        self._fe_data = fe_expected
+        self.response_matrix = None
+        self.response_derivative = None
+        self.ratio_index = None
+
+    @property
+    def spectral_calibration(self):
+        return self._spectral_calibration
+
+    @spectral_calibration.setter
+    def spectral_calibration(self, spectral_calibration):
+        """
+        Новая спектральная калибровка сбрасывает матрицу ожидаемых сигналов
+        """
+        self._spectral_calibration = spectral_calibration
+        self.response_matrix = None
+        self.response_derivative = None
+        self.ratio_index = None
+
+    @property
+    def temperatures(self) -> np.ndarray:
+        return self.results.te if self.results is not None else np.array([])
+
+    @property
+    def density(self) -> np.ndarray:
+        return self.results.ne if self.results is not None else np.array([])
+
+    @property
+    def errors_T(self) -> np.ndarray:
+        return self.results.te_err if self.results is not None else np.array([])
 
-        self.errors_T = []
-        self.errors_n = []
+    @property
+    def errors_n(self) -> np.ndarray:
+        return self.results.ne_err if self.results is not None else np.array([])
 
     def load_spectral_calibration(self, spectral_calib_path):
         try:
@@ -88,154 +224,219 @@ class Polychromator:
             pass
 
     def get_signal_integrals(
-        self, shots_before_plasma: int = 4, shots_after: int = 17, t_step: float = 0.325
-    ) -> tuple[list, list]:
+        self,
+        shots_before_plasma: int = 4,
+        shots_after: int = 17,
+        t_step: float = 0.325,
+        noise_len: int = 400,
+    ) -> tuple[np.ndarray, np.ndarray]:
         """
         RETURNS PHE
         :param shots_before_plasma:
         :param shots_after:
         :param t_step:
-        :return:
+        :param noise_len:
+        :return: phe и шум phe, массивы (shots, ch)
         """
-        excess_noise_factor = 3
-        all_const = self.gain.resulting_multiplier
-        noise_len = 400
-
-        all_shots_signal = []
-        all_shots_noise = []
-        for shot in range(1, shots_before_plasma + shots_after):
-            all_ch_signal = []
-            all_ch_noise = []
-            for poly_ch in range(self.ch_number):
-                signal_ind = [
-                    bisect.bisect_left(
-                        self.signals_time[shot], self.config[poly_ch]["sig_LeftBord"]
-                    ),
-                    bisect.bisect_right(
-                        self.signals_time[shot], self.config[poly_ch]["sig_RightBord"]
-                    ),
-                ]
-
-                signal_lvl = statistics.median(self.signals[poly_ch][shot][:noise_len])
-                lvl_integral = signal_lvl * (
-                    self.config[poly_ch]["sig_RightBord"]
-                    - self.config[poly_ch]["sig_LeftBord"]
-                )
-
-                signal_integral = (
-                    sum(self.signals[poly_ch][shot][signal_ind[0] : signal_ind[1]])
-                    * t_step
-                    - lvl_integral
-                )
-                phe_number = signal_integral * all_const
-
-                noise_track = (
-                    (statistics.stdev(self.signals[poly_ch][shot][:noise_len]))
-                    * all_const
-                    * t_step
-                    * (signal_ind[1] - signal_ind[0])
-                ) ** 2
+        shots = slice(1, shots_before_plasma + shots_after)
+        left_ind, right_ind, borders = get_signal_windows(
+            self.signals_time[shots], self.config[: self.ch_number]
+        )
+        return integrate_signals(
+            self.get_waveforms()[shots],
+            left_ind,
+            right_ind,
+            borders,
+            all_const=self.gain.resulting_multiplier,
+            t_step=t_step,
+            noise_len=noise_len,
+            waveform_index=self.get_waveform_index()[shots],
+            noise_statistics=tuple(
+                stat[shots] for stat in self.get_noise_statistics(noise_len)
+            ),
+        )
 
-                if phe_number > 0:
-                    noise_excess = phe_number * excess_noise_factor
-                else:
-                    phe_number = 1
-                    noise_excess = 0
-                all_ch_signal.append(phe_number)
-                all_ch_noise.append((noise_track + noise_excess) ** 0.5)
+    def get_waveforms(self) -> np.ndarray:
+        """
+        Сигналы полихроматора массивом (shots, ch, 1024)
+        """
+        return np.asarray(self.signals).swapaxes(0, 1)
 
-            all_shots_signal.append(all_ch_signal)
-            all_shots_noise.append(all_ch_noise)
+    def get_waveform_index(self) -> WaveformIndex:
+        """
+        Индекс накопленных сумм сигналов (shots, ch), строится один раз
+        """
+        if self.waveform_index is None:
+            self.waveform_index = WaveformIndex(self.get_waveforms())
+        return self.waveform_index
 
-        return all_shots_signal, all_shots_noise
+    def get_noise_statistics(self, noise_len: int = 400) -> tuple:
+        """
+        Уровень над нулем и шум каждого выстрела и канала (shots, ch).
+        Считается один раз, пересчитывается только при новых signals или noise_len
+        """
+        if self.noise_statistics is None or self.noise_statistics[0] != noise_len:
+            self.noise_statistics = (
+                noise_len,
+                get_noise_statistics(
+                    self.get_waveforms(), noise_len, self.get_waveform_index()
+                ),
+            )
+        return self.noise_statistics[1]
 
-    def get_temperatures(self):
+    def get_temperatures(
+        self,
+        refine: bool = False,
+        te_tolerance: float = 1e-3,
+        ratio_seed: bool = False,
+        seed_half_width: int = 100,
+        te_stride: int = 1,
+    ):
         """
         GIVES TEMPERATURE LIST
+        :param refine: уточнять Te между точками сетки fe_data
+        :param te_tolerance: точность уточнения Te, эВ
+        :param ratio_seed: перебирать Te только в окне вокруг оценки RatioIndex,
+            выстрелы с минимумом на краю окна или хуже точек сетки через
+            seed_half_width перебираются по всей сетке
+        :param seed_half_width: полуширина окна в точках сетки
+        :param te_stride: прореживание сетки на грубом проходе перебора,
+            1 - полный перебор, больше 1 - быстрее, но не гарантирует
+            глобальный минимум
         :return:
         """
-        self.signals_integrals, self.signals_noise_integrals = (
-            self.get_signal_integrals()
-        )
-        results = []
-        for shot_integral, noise in zip(
-            self.signals_integrals, self.signals_noise_integrals
-        ):
-            ans = []
-            for index, (T_e, f_e) in enumerate(self.fe_data.items()):
-                khi = 0
-                if index >= 2:
-                    sum_1 = 0
-                    sum_2 = 0
-                    for ch in range(self.ch_number):
-                        sum_1 += (
-                            shot_integral[ch]
-                            * (f_e[ch] * self.spectral_calibration[ch])
-                            / noise[ch] ** 2
-                        )
-                        sum_2 += (f_e[ch] * self.spectral_calibration[ch]) ** 2 / noise[
-                            ch
-                        ] ** 2
-
-                    for ch in range(self.ch_number):
-                        khi += (
-                            shot_integral[ch]
-                            - sum_1 * (f_e[ch] * self.spectral_calibration[ch]) / sum_2
-                        ) ** 2 / noise[ch] ** 2
-                    ans.append({T_e: khi})
-
-            results.append(ans)
-
-        for shot_integral in results:
-            sort = sorted(shot_integral, key=lambda x: list(x.values())[0])
-            for T in sort[0].keys():
-                self.temperatures.append(T)
+        if self.integrals_outdated():
+            self.signals_integrals, self.signals_noise_integrals = (
+                self.get_signal_integrals()
+            )
+        response = self.get_response_matrix()
+        if ratio_seed:
+            te_ind, chi_min, on_edge = fit_temperature_window(
+                self.signals_integrals,
+                self.signals_noise_integrals,
+                response,
+                self.get_ratio_index().query(self.signals_integrals),
+                seed_half_width,
+            )
+            # проверка окна: точки сетки через seed_half_width не лучше его минимума
+            check_chi = get_chi_squared(
+                self.signals_integrals,
+                self.signals_noise_integrals,
+                response[::seed_half_width],
+            )
+            rescan = (
+                on_edge
+                | np.isnan(chi_min)
+                | np.any(check_chi < chi_min[:, None], axis=-1)
+            )
+            if np.any(rescan):
+                te_ind[rescan], _ = fit_temperature(
+                    self.signals_integrals[rescan],
+                    self.signals_noise_integrals[rescan],
+                    response,
+                    stride=te_stride,
+                )
+        else:
+            te_ind, _ = fit_temperature(
+                self.signals_integrals,
+                self.signals_noise_integrals,
+                response,
+                stride=te_stride,
+            )
+        if refine:
+            temperatures = refine_temperature(
+                self.signals_integrals,
+                self.signals_noise_integrals,
+                self.fe_data.te_grid,
+                response,
+                te_ind,
+                te_tolerance=te_tolerance,
+            )
+        else:
+            temperatures = self.fe_data.te_grid[te_ind]
+        self.results = FiberResults(temperatures)
 
-    def get_density(self, apd_gain: float = 100):
+    def get_response_matrix(self) -> np.ndarray:
+        """
+        Ожидаемые сигналы каналов с учетом спектральной калибровки.
+        Считается один раз, пересчитывается при новых fe_data или spectral_calibration
+        :return: матрица (Te, ch) на сетке fe_data.te_grid, только для чтения
+        """
+        if self.response_matrix is None:
+            self.response_matrix = self.fe_data.fe[:, : self.ch_number] * np.array(
+                self.spectral_calibration[: self.ch_number], dtype=float
+            )
+            self.response_matrix.flags.writeable = False
+        return self.response_matrix
+
+    def get_response_derivative(self) -> np.ndarray:
+        """
+        dfe/dTe с учетом спектральной калибровки, кэшируется как get_response_matrix
+        :return: матрица (Te, ch), у последней точки сетки nan
+        """
+        if self.response_derivative is None:
+            self.response_derivative = self.fe_data.fe_derivative[
+                :, : self.ch_number
+            ] * np.array(self.spectral_calibration[: self.ch_number], dtype=float)
+            self.response_derivative.flags.writeable = False
+        return self.response_derivative
+
+    def get_ratio_index(self) -> RatioIndex:
+        """
+        Индекс отношений каналов по get_response_matrix, кэшируется вместе с ней
+        """
+        if self.ratio_index is None:
+            self.ratio_index = RatioIndex(self.get_response_matrix())
+        return self.ratio_index
+
+    def get_temperature_preview(self, phe: np.ndarray) -> np.ndarray:
+        """
+        Мгновенная оценка Te по отношениям каналов, без подгонки
+        :param phe: фотоэлектроны (..., ch)
+        :return: Te (...)
+        """
+        return self.fe_data.te_grid[self.get_ratio_index().query(phe)]
+
+    def get_density_coefficient(self, apd_gain: float = 100) -> float:
+        """
+        Перевод амплитуды подгонки sum_1 / sum_2 в ne
+        """
         electron_radius = 2.81e-15
         e_charge = 1.6e-19
 
-        if not self.temperatures:
+        return (
+            self.laser.laser_energy
+            * (self.laser.laser_wl / (apd_gain * e_charge))
+            * self.absolut_calibration
+            * electron_radius**2
+        )
+
+    def get_density(self, apd_gain: float = 100):
+        if self.results is None:
             self.get_temperatures()
 
-        for shot_phe, noise_phe, T_e in zip(
-            self.signals_integrals, self.signals_noise_integrals, self.temperatures
-        ):
-            sum_numerator = 0
-            sum_divider = 0
-            for ch in range(self.ch_number):
-                sum_numerator += (
-                    shot_phe[ch]
-                    * (self.fe_data[T_e][ch] * self.spectral_calibration[ch])
-                    / noise_phe[ch] ** 2
-                )
-                sum_divider += (
-                    self.fe_data[T_e][ch] * self.spectral_calibration[ch]
-                ) ** 2 / noise_phe[ch] ** 2
-
-            self.density.append(
-                str(
-                    sum_numerator
-                    / (
-                        sum_divider
-                        * self.laser.laser_energy
-                        * (self.laser.laser_wl / (apd_gain * e_charge))
-                        * self.absolut_calibration
-                        * electron_radius**2
-                    )
-                )
-            )
+        response = interpolate_response(
+            self.fe_data.te_grid, self.get_response_matrix(), self.temperatures
+        )
+        weight = 1 / self.signals_noise_integrals**2
+        sum_numerator = np.sum(self.signals_integrals * response * weight, axis=1)
+        sum_divider = np.sum(response**2 * weight, axis=1)
 
-    def get_errors(self):
-        ch_nums = self.ch_number
+        self.results.ne = sum_numerator / (
+            sum_divider * self.get_density_coefficient(apd_gain)
+        )
 
+    def get_errors_coefficient(self) -> float:
+        """
+        Перевод ne * fe в фотоэлектроны для оценки ошибок
+        """
         electron_radius = 2.81e-15
         laser_wl = 1064.4e-9
         e_charge = 1.6e-19
         M = 100
         laser_energy = 1.5
 
-        full_coef = (
+        return (
             self.absolut_calibration
             * laser_energy
             * electron_radius**2
@@ -243,50 +444,38 @@ class Polychromator:
             / (M * e_charge)
         )
 
-        for shot_noise, T_e in zip(self.signals_noise_integrals, self.temperatures):
-            try:
-                shot_num = self.signals_noise_integrals.index(shot_noise)
-                T_e_ind = self.fe_data["Te_grid"].index(float(T_e))
-                T_e_next = str(self.fe_data["Te_grid"][T_e_ind + 1])
-
-                sum_fe_to_noise = 0
-                sum_derivative_fe_to_noise = 0
-                sum_fe_derivative_fe_to_noise = 0
-                T_e_step = float(T_e_next) - float(T_e)
-                for ch in range(ch_nums):
-                    derivative_fe = (
-                        self.fe_data[T_e][ch] - self.fe_data[T_e_next][ch]
-                    ) / T_e_step
-
-                    sum_fe_to_noise += (self.fe_data[T_e][ch] / shot_noise[ch]) ** 2
-                    sum_derivative_fe_to_noise += (derivative_fe / shot_noise[ch]) ** 2
-                    sum_fe_derivative_fe_to_noise += (
-                        derivative_fe * self.fe_data[T_e][ch] / shot_noise[ch] ** 2
-                    ) ** 2
-
-                M_errT = sum_fe_to_noise / (
-                    sum_fe_to_noise * sum_derivative_fe_to_noise
-                    - sum_fe_derivative_fe_to_noise
-                )
-
-                M_errn = sum_derivative_fe_to_noise / (
-                    sum_fe_to_noise * sum_derivative_fe_to_noise
-                    - sum_fe_derivative_fe_to_noise
-                )
-
-                self.errors_T.append(
-                    str(
-                        math.sqrt(
-                            M_errT / (float(self.density[shot_num]) * full_coef) ** 2
-                        )
-                    )
-                )
+    def get_errors_inputs(self) -> tuple:
+        """
+        :return: шум, ожидаемые сигналы и их производные при найденной Te (shots, ch)
+        """
+        te_ind = self.fe_data.get_index(self.temperatures)
+        return (
+            self.signals_noise_integrals,
+            self.get_response_matrix()[te_ind],
+            self.get_response_derivative()[te_ind],
+        )
 
-                self.errors_n.append(str(math.sqrt(M_errn / full_coef**2)))
+    def density_missing(self) -> bool:
+        """
+        ne еще не считалась: нет результатов или get_density не вызывалась
+        """
+        return self.results is None or np.all(np.isnan(self.results.ne))
 
-            except (IndexError, ZeroDivisionError, ValueError):
-                self.errors_T.append(0)
-                self.errors_n.append(0)
+    def get_errors(self):
+        # без ne все выстрелы молча получили бы ERROR_NO_DENSITY
+        if self.density_missing():
+            self.get_density()
+
+        noise, expected, expected_derivative = self.get_errors_inputs()
+        self.results.set_errors(
+            *get_fisher_errors(
+                noise,
+                expected,
+                expected_derivative,
+                self.results.ne,
+                self.get_errors_coefficient(),
+            )
+        )
 
     def get_expected_phe(self):
         from_shot = 5
@@ -295,12 +484,18 @@ class Polychromator:
         electron_radius = 6.6e-29
         laser_energy = 1.5
 
-        for shot, T_e, n_e in zip(
-            self.signals_integrals[from_shot:to_shot],
-            self.temperatures[from_shot:to_shot],
-            self.density[from_shot:to_shot],
+        for shot_num, (shot, T_e, n_e) in enumerate(
+            zip(
+                self.signals_integrals[from_shot:to_shot],
+                self.temperatures[from_shot:to_shot],
+                self.density[from_shot:to_shot],
+            ),
+            start=from_shot,
         ):
-            print("shot_number ", self.signals_noise_integrals.index(shot), end="  ")
+            expected = interpolate_response(
+                self.fe_data.te_grid, self.get_response_matrix(), T_e
+            )
+            print("shot_number ", shot_num, end="  ")
             print(
                 T_e,
                 n_e,
@@ -308,18 +503,18 @@ class Polychromator:
                 shot[0],
                 "expected",
                 self.absolut_calibration
-                * self.fe_data[T_e][0]
+                * expected[0]
                 * electron_radius
                 * laser_energy
-                * float(n_e),
+                * n_e,
                 "got",
                 shot[1],
                 "expected",
                 self.absolut_calibration
-                * self.fe_data[T_e][1]
+                * expected[1]
                 * electron_radius
                 * laser_energy
-                * float(n_e),
+                * n_e,
             )
 
     def plot_raw_signals(self, from_shot: int = 10, to_shot: int | str = 20):
@@ -330,10 +525,11 @@ class Polychromator:
         elif str.lower(to_shot) == "all":
             to_shot = len(self.signals[0])
 
+        times = self.signals_time[from_shot:to_shot].expand()
         for ch in range(len(self.signals)):
             for shot in range(from_shot, to_shot):
-                time, signal = self.get_raw_data(shot_num=shot, ch_num=ch)
-                ax[ch].plot(time, signal, label="shot %d" % shot)
+                signal = self.signals[ch][shot]
+                ax[ch].plot(times[shot - from_shot], signal, label="shot %d" % shot)
                 ax[ch].set_xlim([0, 80])
         ax[0].legend(ncol=3)
         plt.subplots_adjust(left=0.05, right=0.95, top=0.96, bottom=0.07)
@@ -342,7 +538,7 @@ class Polychromator:
 
     def get_raw_data(self, shot_num: int = None, ch_num: int = None):
         if ch_num is None and shot_num is None:
-            return self.signals_time, self.signals
+            return self.signals_time.expand(), self.signals
         return self.signals_time[shot_num], self.signals[ch_num][shot_num]
 
     def write_raw_signals(self, path: Path):
@@ -364,88 +560,189 @@ class SignalProcession:
     def get_signals_integrals(
         poly: Polychromator, shots_number: int = 25, t_step=0.325
     ):
-        excess_noise_factor = 3
-        all_const = poly.gain.resulting_multiplier
-        noise_len = 400
-
-        all_shots_signal = []
-        all_shots_noise = []
-        for shot in range(1, shots_number):
-            all_ch_signal = []
-            all_ch_noise = []
-            for poly_ch in range(poly.ch_number):
-                signal_ind = [
-                    bisect.bisect_left(
-                        poly.signals_time[shot], poly.config[poly_ch]["sig_LeftBord"]
-                    ),
-                    bisect.bisect_right(
-                        poly.signals_time[shot], poly.config[poly_ch]["sig_RightBord"]
-                    ),
-                ]
-
-                signal_lvl = statistics.median(poly.signals[poly_ch][shot][:noise_len])
-                lvl_integral = signal_lvl * (
-                    poly.config[poly_ch]["sig_RightBord"]
-                    - poly.config[poly_ch]["sig_LeftBord"]
-                )
+        shots = slice(1, shots_number)
+        left_ind, right_ind, borders = get_signal_windows(
+            poly.signals_time[shots], poly.config[: poly.ch_number]
+        )
+        return integrate_signals(
+            poly.get_waveforms()[shots],
+            left_ind,
+            right_ind,
+            borders,
+            all_const=poly.gain.resulting_multiplier,
+            t_step=t_step,
+        )
 
-                signal_integral = (
-                    sum(poly.signals[poly_ch][shot][signal_ind[0] : signal_ind[1]])
-                    * t_step
-                    - lvl_integral
+    @staticmethod
+    def get_fibers_integrals(
+        fibers: list[Polychromator],
+        shots_before_plasma: int = 4,
+        shots_after: int = 17,
+        t_step: float = 0.325,
+    ) -> list[tuple[np.ndarray, np.ndarray]]:
+        """
+        phe и шум phe всех волокон разряда одним проходом по массиву
+        (fiber, shot, ch, 1024), результат записывается в fiber.signals_integrals
+        и fiber.signals_noise_integrals
+        :return: [(phe, шум phe)] в порядке fibers
+        """
+        shots = slice(1, shots_before_plasma + shots_after)
+
+        groups = {}
+        for fiber_ind, fiber in enumerate(fibers):
+            shape = fiber.get_waveform_index()[shots].cumsum.shape
+            groups.setdefault(shape[1:], []).append(fiber_ind)
+
+        results = [None] * len(fibers)
+        for fibers_ind in groups.values():
+            windows = [
+                get_signal_windows(
+                    fibers[ind].signals_time[shots],
+                    fibers[ind].config[: fibers[ind].ch_number],
                 )
-                phe_number = signal_integral * all_const
-
-                noise_track = (
-                    (statistics.stdev(poly.signals[poly_ch][shot][:noise_len]))
-                    * all_const
-                    * t_step
-                    * (signal_ind[1] - signal_ind[0])
-                ) ** 2
-                if phe_number > 0:
-                    noise_excess = phe_number * excess_noise_factor
-                else:
-                    phe_number = 1
-                    noise_excess = 0
-                all_ch_signal.append(phe_number)
-                all_ch_noise.append((noise_track + noise_excess) ** 0.5)
+                for ind in fibers_ind
+            ]
+            left_ind, right_ind, borders = (np.stack(arr) for arr in zip(*windows))
+            all_const = np.array(
+                [fibers[ind].gain.resulting_multiplier for ind in fibers_ind]
+            )
+            noise_statistics = [
+                fibers[ind].get_noise_statistics() for ind in fibers_ind
+            ]
+
+            # суммы по окнам и шум берутся из кэшей волокон, сами сигналы не нужны
+            phe, noise = integrate_signals(
+                None,
+                left_ind,
+                right_ind,
+                borders[:, None],
+                all_const=all_const[:, None, None],
+                t_step=t_step,
+                waveform_index=WaveformIndex.stack(
+                    [fibers[ind].get_waveform_index()[shots] for ind in fibers_ind]
+                ),
+                noise_statistics=(
+                    np.stack([lvl[shots] for lvl, _ in noise_statistics]),
+                    np.stack([std[shots] for _, std in noise_statistics]),
+                ),
+            )
+            for group_ind, ind in enumerate(fibers_ind):
+                results[ind] = (phe[group_ind], noise[group_ind])
 
-            all_shots_signal.append(all_ch_signal)
-            all_shots_noise.append(all_ch_noise)
+        for fiber, (phe, noise) in zip(fibers, results):
+            fiber.signals_integrals, fiber.signals_noise_integrals = phe, noise
 
-        return all_shots_signal, all_shots_noise
+        return results
 
 
 class PlasmaParametersCalculator:
     @staticmethod
-    def calculate_ne_te(poly: Polychromator):
-        signals_integrals, signals_noise_integrals = poly.get_signal_integrals()
-        pass
+    def get_fibers_errors(fibers: list[Polychromator]):
+        """
+        Ошибки Te и ne всех выстрелов всех волокон: волокна с одинаковым
+        числом каналов и выстрелов считаются одним выражением
+        :param fibers: волокна с посчитанными Te и ne
+        """
+        groups = {}
+        for ind, fiber in enumerate(fibers):
+            if fiber.density_missing():
+                fiber.get_density()
+            groups.setdefault(fiber.signals_noise_integrals.shape, []).append(ind)
+
+        for fibers_ind in groups.values():
+            noise, expected, expected_derivative = (
+                np.stack(inputs)
+                for inputs in zip(
+                    *(fibers[ind].get_errors_inputs() for ind in fibers_ind)
+                )
+            )
+            te_err, ne_err, flags = get_fisher_errors(
+                noise,
+                expected,
+                expected_derivative,
+                np.stack([fibers[ind].results.ne for ind in fibers_ind]),
+                np.array(
+                    [[fibers[ind].get_errors_coefficient()] for ind in fibers_ind]
+                ),
+            )
+            for row, ind in enumerate(fibers_ind):
+                fibers[ind].results.set_errors(te_err[row], ne_err[row], flags[row])
 
     @staticmethod
-    def create_phe_table(poly: Polychromator):
-        electron_radius = 2.81e-15
-        e_charge = 1.6e-19
-        apd_gain = 100
-
-        te_grid = poly.fe_data["Te_grid"][:1000]
-        ne_grid = [5e17 + 1e17 * count for count in range(1000)]
+    def get_fibers_monte_carlo(
+        fibers: list[Polychromator],
+        realizations: int = 1000,
+        percentiles: tuple[float, float] = (15.87, 84.13),
+        seed: int = 0,
+        chunk_size: int = 50,
+        refine: bool = False,
+        processes: int = None,
+    ):
+        """
+        Интервалы Te и ne методом Монте-Карло для всех волокон.
+        Реализации делятся на пачки, пачки всех волокон считаются в пуле процессов.
+        Каждая пачка получает свой SeedSequence из seed, поэтому результат
+        не зависит от числа процессов
+        :param fibers: волокна с посчитанными Te и ne
+        :param realizations: число реализаций на выстрел
+        :param percentiles: границы интервала в процентах
+        :param seed: начальное значение генератора
+        :param chunk_size: реализаций в пачке, память пачки ~ chunk_size * shots * Te
+        :param refine: уточнять Te между точками сетки
+        :param processes: число процессов, 1 - без пула
+        """
+        chunks = [
+            min(chunk_size, realizations - start)
+            for start in range(0, realizations, chunk_size)
+        ]
+        fiber_seeds = np.random.SeedSequence(seed).spawn(len(fibers))
+
+        args_list = []
+        for fiber, fiber_seed in zip(fibers, fiber_seeds):
+            if fiber.density_missing():
+                fiber.get_density()
+            phe = np.asarray(fiber.signals_integrals, dtype=float)
+            noise = np.asarray(fiber.signals_noise_integrals, dtype=float)
+            response = fiber.get_response_matrix()
+            args_list.extend(
+                (phe, noise, fiber.fe_data.te_grid, response, chunk_seed, size, refine)
+                for chunk_seed, size in zip(fiber_seed.spawn(len(chunks)), chunks)
+            )
 
-        constant = (
-            poly.absolut_calibration
-            * poly.laser.laser_energy
-            * poly.laser.laser_wl
-            * electron_radius**2
-            / (apd_gain * e_charge)
-        )
+        if processes is None:
+            processes = min(len(args_list), mp.cpu_count())
+        if processes > 1:
+            with mp.Pool(processes=processes) as pool:
+                results = pool.map(monte_carlo_chunk, args_list)
+        else:
+            results = [monte_carlo_chunk(args) for args in args_list]
+
+        for ind, fiber in enumerate(fibers):
+            fiber_results = results[ind * len(chunks) : (ind + 1) * len(chunks)]
+            te = np.concatenate([te for te, _ in fiber_results])
+            ne = (
+                np.concatenate([amplitude for _, amplitude in fiber_results])
+                / fiber.get_density_coefficient()
+            )
+            fiber.results.te_interval = np.percentile(te, percentiles, axis=0).T
+            fiber.results.ne_interval = np.percentile(ne, percentiles, axis=0).T
 
-        all_phe = []
-        for te in te_grid:
-            phe = []
-            for ne in ne_grid:
-                phe_amount = constant * poly.fe_data[str(te)][1] * ne
-                phe.append(phe_amount)
-            all_phe.append(phe)
+    @staticmethod
+    def calculate_ne_te(
+        poly: Polychromator,
+        te_stride: int = 1,
+        refine: bool = True,
+    ) -> (np.ndarray, np.ndarray):
+        """
+        Te и ne одного полихроматора: перебор get_temperatures и get_density
+        :param poly: полихроматор
+        :param te_stride: прореживание сетки на грубом проходе get_temperatures
+        :param refine: уточнять Te между точками сетки fe
+        :return: Te и ne по выстрелам, также записываются в poly.results
+        """
+        poly.get_temperatures(refine=refine, te_stride=te_stride)
+        poly.get_density()
+        return poly.temperatures, poly.density
 
 
 def built_fibers(
@@ -453,29 +750,56 @@ def built_fibers(
     config: dict,
     calibration_flag: bool = False,
     laser: LaserNdYag = None,
+    multiprocess: bool = True,
+    use_cache: bool = True,
 ) -> (list, list[Polychromator]):
 
     with open(config["poly_fiber_caen_connection"]) as file:
         config_connection = json.load(file)
 
     if calibration_flag:
-        experiment_data = handle_all_caens(
+        data_path = config["path_calib_data"]
+        processed_shots = "all"
+    else:
+        data_path = config["path_experimental_data"]
+        processed_shots = 30
+
+    used_channels = get_used_caen_channels(config_connection)
+
+    if use_cache:
+        experiment_data = handle_all_caens_cached(
+            discharge_num=discharge_num,
+            path=data_path,
+            processed_shots=processed_shots,
+            multiprocess=multiprocess,
+            channels=used_channels,
+        )
+    elif multiprocess:
+        experiment_data = handle_all_caens_multiproces(
             discharge_num=discharge_num,
-            path=config["path_calib_data"],
-            processed_shots="all",
+            path=data_path,
+            processed_shots=processed_shots,
+            channels=used_channels,
         )
     else:
         experiment_data = handle_all_caens(
             discharge_num=discharge_num,
-            path=config["path_experimental_data"],
-            processed_shots=30,
+            path=data_path,
+            processed_shots=processed_shots,
+            as_array=True,
+            channels=used_channels,
         )
 
     all_caens = experiment_data["caens_data"]
     combiscope_times = experiment_data["combiscope_times"]
 
-    handmade_poly_data = all_caens[0]["caen_channels"][2:6]
-    handmade_poly_data.insert(0, all_caens[1]["caen_channels"][6])
+    handmade_poly_data = np.concatenate(
+        (
+            get_caen_channels(all_caens[1], [6]),
+            get_caen_channels(all_caens[0], range(2, 6)),
+        ),
+        axis=1,
+    )
 
     equatorGain = GainsEquator()
     t15_34_Gain = Gains_T15_34()
@@ -513,7 +837,7 @@ def built_fibers(
         spectral_calib=config["path_spectral_calibration"],
         absolut_calib=config["path_absolute_calibration"],
         caen_time=all_caens[2]["shots_time"],
-        caen_data=all_caens[2]["caen_channels"][1:5],
+        caen_data=get_caen_channels(all_caens[2], range(1, 5)),
     )
 
     poly_047 = Polychromator(
@@ -527,7 +851,7 @@ def built_fibers(
         spectral_calib=config["path_spectral_calibration"],
         absolut_calib=config["path_absolute_calibration"],
         caen_time=all_caens[2]["shots_time"],
-        caen_data=all_caens[2]["caen_channels"][6:10],
+        caen_data=get_caen_channels(all_caens[2], range(6, 10)),
     )
 
     poly_048 = Polychromator(
@@ -541,7 +865,7 @@ def built_fibers(
         spectral_calib=config["path_spectral_calibration"],
         absolut_calib=config["path_absolute_calibration"],
         caen_time=all_caens[2]["shots_time"],
-        caen_data=all_caens[2]["caen_channels"][11:15],
+        caen_data=get_caen_channels(all_caens[2], range(11, 15)),
     )
 
     poly_049 = Polychromator(
@@ -555,7 +879,7 @@ def built_fibers(
         spectral_calib=config["path_spectral_calibration"],
         absolut_calib=config["path_absolute_calibration"],
         caen_time=all_caens[3]["shots_time"],
-        caen_data=all_caens[3]["caen_channels"][1:5],
+        caen_data=get_caen_channels(all_caens[3], range(1, 5)),
     )
 
     poly_050 = Polychromator(
@@ -569,7 +893,7 @@ def built_fibers(
         spectral_calib=config["path_spectral_calibration"],
         absolut_calib=config["path_absolute_calibration"],
         caen_time=all_caens[3]["shots_time"],
-        caen_data=all_caens[3]["caen_channels"][6:10],
+        caen_data=get_caen_channels(all_caens[3], range(6, 10)),
     )
 
     poly_T15_34 = Polychromator(
@@ -583,7 +907,7 @@ def built_fibers(
         spectral_calib=config["path_spectral_calibration"],
         absolut_calib=config["path_absolute_calibration"],
         caen_time=all_caens[1]["shots_time"],
-        caen_data=all_caens[1]["caen_channels"][11:15],
+        caen_data=get_caen_channels(all_caens[1], range(11, 15)),
     )
 
     poly_T15_35 = Polychromator(
@@ -597,7 +921,7 @@ def built_fibers(
         spectral_calib=config["path_spectral_calibration"],
         absolut_calib=config["path_absolute_calibration"],
         caen_time=all_caens[3]["shots_time"],
-        caen_data=all_caens[3]["caen_channels"][11:15],
+        caen_data=get_caen_channels(all_caens[3], range(11, 15)),
     )
 
     poly_novosib = Polychromator(
@@ -609,7 +933,7 @@ def built_fibers(
         laser=laser,
         spectral_calib=config["path_spectral_calibration"],
         caen_time=all_caens[0]["shots_time"],
-        caen_data=all_caens[0]["caen_channels"][6:10],
+        caen_data=get_caen_channels(all_caens[0], range(6, 10)),
     )
 
     del all_caens
@@ -624,14 +948,34 @@ def built_fibers(
         poly_T15_35,
     ]
 
+    # своя таблица fe для угла рассеяния каждого волокна, json {poly_name: угол}
+    scattering_angles = {}
+    if config.get("scattering_angles"):
+        with open(config["scattering_angles"]) as file:
+            scattering_angles = json.load(file)
+    fibers_fe = expected_fe.get_fibers_fe(
+        {fiber.poly_name: fiber.fe_data for fiber in fibers}, scattering_angles
+    )
+    for fiber in fibers:
+        fiber.fe_data = fibers_fe[fiber.poly_name]
+
     return combiscope_times, fibers
 
 
-def calculate_Te_ne(fibers: Polychromator | list[Polychromator]):
+def calculate_Te_ne(
+    fibers: Polychromator | list[Polychromator],
+    refine_te: bool = False,
+    monte_carlo_realizations: int = 0,
+):
+    SignalProcession.get_fibers_integrals(fibers)
     for fiber in fibers:
-        fiber.get_temperatures()
+        fiber.get_temperatures(refine=refine_te)
         fiber.get_density()
-        fiber.get_errors()
+    PlasmaParametersCalculator.get_fibers_errors(fibers)
+    if monte_carlo_realizations:
+        PlasmaParametersCalculator.get_fibers_monte_carlo(
+            fibers, realizations=monte_carlo_realizations, refine=refine_te
+        )
 
 
 if __name__ == "__main__":
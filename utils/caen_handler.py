@@ -1,13 +1,101 @@
+import json
 import multiprocessing as mp
+import os
 import sys
 import time
+from multiprocessing import shared_memory
 from pathlib import Path
 
 import msgpack
+import numpy as np
+
+
+class CaenTimeBase:
+    """
+    Оси времени выстрелов каена: time[t] = time_shift - (max_position - t) * t_step,
+    где max_position - отсчет максимума лазерного канала в выстреле.
+    Хранится только max_position на выстрел, полная ось строится по запросу
+    """
+
+    def __init__(
+        self,
+        max_positions,
+        t_step: float = 0.325,
+        time_shift: float = 100,
+        samples_number: int = 1024,
+    ):
+        self.max_positions = np.asarray(max_positions, dtype=np.int64)
+        self.t_step = t_step
+        self.time_shift = time_shift
+        self.samples_number = samples_number
+
+    @classmethod
+    def from_axes(cls, times: list, t_step: float = 0.325, time_shift: float = 100):
+        """
+        Из списков осей времени, построенных caen_msg_handler(as_array=False)
+        """
+        max_positions = [round((time_shift - time[0]) / t_step) for time in times]
+        return cls(max_positions, t_step, time_shift, len(times[0]))
+
+    def __len__(self):
+        return len(self.max_positions)
+
+    def __getitem__(self, shot):
+        if isinstance(shot, slice):
+            return CaenTimeBase(
+                self.max_positions[shot],
+                self.t_step,
+                self.time_shift,
+                self.samples_number,
+            )
+        return self.time_at(self.max_positions[shot], np.arange(self.samples_number))
+
+    def time_at(self, max_positions, indices):
+        return self.time_shift - (max_positions - indices) * self.t_step
+
+    def expand(self) -> np.ndarray:
+        """
+        Полные оси времени (shots, 1024), нужны только для графиков
+        """
+        return self.time_at(
+            self.max_positions[:, None], np.arange(self.samples_number)[None, :]
+        )
+
+    def window_indices(self, left: float, right: float) -> (np.ndarray, np.ndarray):
+        """
+        Границы окна [left, right] в отсчетах для всех выстрелов, то же что
+        bisect_left(time, left) и bisect_right(time, right) по полной оси
+        :return: два массива индексов (shots,)
+        """
+        return (
+            self._bisect(left, side="left"),
+            self._bisect(right, side="right"),
+        )
+
+    def _bisect(self, value: float, side: str) -> np.ndarray:
+        position = self.max_positions + (value - self.time_shift) / self.t_step
+        if side == "left":
+            index = np.ceil(position).astype(np.int64)
+            # поправка на округление: первый отсчет со временем >= value
+            index -= self.time_at(self.max_positions, index - 1) >= value
+            index += self.time_at(self.max_positions, index) < value
+        else:
+            index = np.floor(position).astype(np.int64) + 1
+            # поправка на округление: первый отсчет со временем > value
+            index -= self.time_at(self.max_positions, index - 1) > value
+            index += self.time_at(self.max_positions, index) <= value
+        return np.clip(index, 0, self.samples_number)
 
 
 def caen_msg_handler(
-    path, t_step=0.325, time_shift=100, processed_shots: int | str = 30
+    path,
+    t_step=0.325,
+    time_shift=100,
+    processed_shots: int | str = 30,
+    as_array: bool = False,
+    dtype=np.float32,
+    out: np.ndarray = None,
+    channels: list[int] = None,
 ):
     """
     :param time_shift: сдвиг для построения в одной системе координат
@@ -15,17 +103,23 @@ def caen_msg_handler(
     :param t_step: шаг оцифровщика
     :param noise_len: длина для вычисления уровня над нулем и уровня шума
     :param processed_shots: количество обработанных выстрелов
+    :param as_array: вернуть сигналы одним массивом (shots, 16, 1024) вместо списков
+    :param dtype: тип массива сигналов, np.float32 или np.int16 для сырых отсчетов
+    :param out: готовый массив (shots, 16, 1024) для записи сигналов, например в shared memory
+    :param channels: номера расшифровываемых каналов каена, только для as_array
     :return:
     """
 
+    if as_array:
+        return caen_msg_array(
+            path, processed_shots, t_step, time_shift, dtype, out, channels
+        )
+
     times = []
     caen = []
     caen_channels_number = 16
-    with path.open(mode="rb") as file:
-        data = msgpack.unpackb(file.read())
-
-    if str(processed_shots).lower() == "all":
-        processed_shots = len(data)
+    data = list(iter_caen_shots(path, processed_shots))
+    processed_shots = len(data)
 
     combiscope_times = []
     for caen_channel in range(caen_channels_number):
@@ -45,8 +139,130 @@ def caen_msg_handler(
     return combiscope_times[1:], times, caen  # [1:] - первый нулевой запуск опускаю
 
 
+def iter_caen_shots(path: Path, processed_shots: int | str = "all"):
+    """
+    Потоковое чтение файла каена: выстрелы распаковываются по одному,
+    чтение останавливается после processed_shots выстрелов
+    :param path: путь до файла
+    :param processed_shots: количество обработанных выстрелов
+    :return: генератор словарей выстрелов {"t": ..., "ch": [...]}
+    """
+    with path.open(mode="rb") as file:
+        unpacker = msgpack.Unpacker(file)
+        shots_number = unpacker.read_array_header()
+        if str(processed_shots).lower() != "all":
+            shots_number = min(shots_number, processed_shots)
+
+        for _ in range(shots_number):
+            yield unpacker.unpack()
+
+
+def caen_msg_shape(
+    path: Path, processed_shots: int | str, channels: list[int] = None
+) -> tuple:
+    """
+    Размер массива сигналов файла без полной распаковки: заголовок и первый выстрел
+    :param path: путь до файла
+    :param processed_shots: количество обработанных выстрелов
+    :param channels: номера расшифровываемых каналов, по умолчанию все
+    :return: (shots, channels, 1024)
+    """
+    with path.open(mode="rb") as file:
+        unpacker = msgpack.Unpacker(file)
+        shots_number = unpacker.read_array_header()
+        first_shot = unpacker.unpack()
+
+    if str(processed_shots).lower() != "all":
+        shots_number = min(shots_number, processed_shots)
+    if channels is None:
+        channels = first_shot["ch"]
+    return shots_number, len(channels), len(first_shot["ch"][0])
+
+
+def caen_msg_array(
+    path: Path,
+    processed_shots: int | str,
+    t_step: float,
+    time_shift: float,
+    dtype,
+    out: np.ndarray = None,
+    channels: list[int] = None,
+) -> (list, list, np.ndarray):
+    """
+    Потоково упаковывает файл каена в один непрерывный массив.
+    Лазерный канал 0 нужен только для привязки времени и в массив не попадает,
+    если его нет в channels
+    :param path: путь до файла
+    :param processed_shots: количество обработанных выстрелов
+    :param t_step: шаг оцифровщика
+    :param time_shift: сдвиг для построения в одной системе координат
+    :param dtype: тип массива сигналов
+    :param out: готовый массив для записи сигналов
+    :param channels: номера расшифровываемых каналов, по умолчанию все
+    :return: времена комбископа, CaenTimeBase выстрелов, массив (shots, channels, 1024)
+    """
+    if out is None:
+        caen = np.empty(caen_msg_shape(path, processed_shots, channels), dtype=dtype)
+    else:
+        caen = out
+
+    shots_t = []
+    max_positions = []
+    for laser_shot, shot in enumerate(iter_caen_shots(path, processed_shots)):
+        if channels is None:
+            caen[laser_shot] = shot["ch"]
+        else:
+            caen[laser_shot] = [shot["ch"][ch] for ch in channels]
+        shots_t.append(shot["t"])
+        max_positions.append(np.argmax(np.asarray(shot["ch"][0], dtype=dtype)))
+
+    combiscope_times = [round(shot_t - shots_t[0], 3) for shot_t in shots_t]
+
+    times = CaenTimeBase(max_positions, t_step, time_shift, caen.shape[2])
+
+    return combiscope_times[1:], times, caen  # [1:] - первый нулевой запуск опускаю
+
+
+def get_used_caen_channels(config_connection: dict) -> dict[int, list[int]]:
+    """
+    Каналы каенов, к которым по конфигу подключены спектральные каналы полихроматоров.
+    Лазер, пустые и неопределенные каналы пропускаются
+    :param config_connection: конфиг подключения полихроматоров к каенам
+    :return: {номер каена: [номера каналов]}
+    """
+    used_channels = {}
+    for caen in config_connection["equator_caens"]:
+        used_channels[caen["caen"]] = [
+            channel["caen_ch"]
+            for channel in caen["channels"]
+            if channel["poly"] not in ("None", "laser", "Empty")
+            and isinstance(channel["poly_sp_ch"], int)
+        ]
+    return used_channels
+
+
+def get_caen_channels(caen: dict, channels) -> np.ndarray:
+    """
+    Сигналы выбранных каналов каена, (shots, len(channels), 1024).
+    Для подряд идущих каналов возвращается view без копирования
+    :param caen: словарь каена из handle_all_caens(as_array=True)
+    :param channels: номера каналов каена
+    :return:
+    """
+    caen_channels = list(caen.get("channels", range(caen["caen_channels"].shape[1])))
+    rows = [caen_channels.index(ch) for ch in channels]
+    if rows == list(range(rows[0], rows[0] + len(rows))):
+        return caen["caen_channels"][:, rows[0] : rows[0] + len(rows)]
+    return caen["caen_channels"][:, rows]
+
+
 def handle_all_caens(
-    discharge_num: str, path: str, processed_shots: int | str
+    discharge_num: str,
+    path: str,
+    processed_shots: int | str,
+    as_array: bool = False,
+    dtype=np.float32,
+    channels: dict[int, list[int]] = None,
 ) -> (list, list):
     msg_files_num_x10 = [0, 1, 2, 3]
 
@@ -54,49 +270,346 @@ def handle_all_caens(
     combiscope_times = []
     for msg_num in msg_files_num_x10:
         new_path = Path(f"{path}/{discharge_num}/{str(msg_num)}.msgpk")
+        caen_channels = channels[msg_num] if channels is not None else None
         combiscope_times, times, caen_data = caen_msg_handler(
-            new_path, processed_shots=processed_shots
-        )
-        all_caens.append(
-            {"caen_num": msg_num, "shots_time": times, "caen_channels": caen_data}
+            new_path,
+            processed_shots=processed_shots,
+            as_array=as_array,
+            dtype=dtype,
+            channels=caen_channels,
         )
+        caen = {"caen_num": msg_num, "shots_time": times, "caen_channels": caen_data}
+        if as_array:
+            caen["channels"] = (
+                caen_channels
+                if caen_channels is not None
+                else list(range(caen_data.shape[1]))
+            )
+        all_caens.append(caen)
 
     return {"combiscope_times": combiscope_times, "caens_data": all_caens}
 
 
 def handle_one_caen(args):
-    discharge_num, path, msg_num, processed_shots = args
-    new_path = Path(rf"{path}\{discharge_num}\{msg_num}.msgpk")
-    combiscope_times, times, caen_data = caen_msg_handler(
-        new_path, processed_shots=processed_shots
+    """
+    Обработка одного файла в отдельном процессе, сигналы пишутся прямо в shared memory
+    :param args: (discharge_num, path, msg_num, processed_shots, channels, shm_name, shape, dtype)
+    :return:
+    """
+    discharge_num, path, msg_num, processed_shots, channels, shm_name, shape, dtype = (
+        args
     )
-    caen_num = msg_num
+    new_path = Path(path) / str(discharge_num) / f"{msg_num}.msgpk"
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        out = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        combiscope_times, times, _ = caen_msg_handler(
+            new_path,
+            processed_shots=processed_shots,
+            as_array=True,
+            out=out,
+            channels=channels,
+        )
+        del out
+    finally:
+        shm.close()
+
     return {
-        "caen_num": caen_num,
+        "caen_num": msg_num,
         "shots_time": times,
-        "caen_channels": caen_data,
         "combiscope_times": combiscope_times,
     }
 
 
 def handle_all_caens_multiproces(
-    discharge_num: str, path: str, msg_list: list, processed_shots: int | str
-) -> list:
+    discharge_num: str,
+    path: str,
+    processed_shots: int | str,
+    msg_list: list = None,
+    dtype=np.float32,
+    channels: dict[int, list[int]] = None,
+) -> dict:
     """
-    Multiprocess script_DTS
+    Параллельная обработка файлов каенов, по процессу на файл.
+    Возвращает ту же структуру, что и handle_all_caens(as_array=True)
     :param discharge_num:
     :param path:
-    :param msg_list:
     :param processed_shots:
+    :param msg_list: номера файлов каенов, по умолчанию [0, 1, 2, 3]
+    :param dtype: тип массива сигналов
+    :param channels: {номер каена: номера каналов}, по умолчанию все каналы
     :return:
     """
-    args_list = [
-        (discharge_num, path, msg_num, processed_shots) for msg_num in msg_list
+    if msg_list is None:
+        msg_list = [0, 1, 2, 3]
+    if channels is None:
+        channels = {msg_num: None for msg_num in msg_list}
+
+    shapes = [
+        caen_msg_shape(
+            Path(path) / str(discharge_num) / f"{msg_num}.msgpk",
+            processed_shots,
+            channels[msg_num],
+        )
+        for msg_num in msg_list
+    ]
+    # память выделяет родительский процесс: обработчики только пишут в неё
+    shared_blocks = [
+        shared_memory.SharedMemory(
+            create=True, size=max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+        )
+        for shape in shapes
+    ]
+
+    try:
+        args_list = [
+            (
+                discharge_num,
+                path,
+                msg_num,
+                processed_shots,
+                channels[msg_num],
+                shm.name,
+                shape,
+                dtype,
+            )
+            for msg_num, shm, shape in zip(msg_list, shared_blocks, shapes)
+        ]
+        with mp.Pool(processes=min(len(args_list), mp.cpu_count())) as pool:
+            results = pool.map(handle_one_caen, args_list)
+
+        all_caens = []
+        for result, shm, shape in zip(results, shared_blocks, shapes):
+            all_caens.append(
+                {
+                    "caen_num": result["caen_num"],
+                    "shots_time": result["shots_time"],
+                    "caen_channels": np.ndarray(
+                        shape, dtype=dtype, buffer=shm.buf
+                    ).copy(),
+                    "channels": (
+                        channels[result["caen_num"]]
+                        if channels[result["caen_num"]] is not None
+                        else list(range(shape[1]))
+                    ),
+                }
+            )
+    finally:
+        for shm in shared_blocks:
+            shm.close()
+            shm.unlink()
+
+    return {
+        "combiscope_times": results[-1]["combiscope_times"],
+        "caens_data": all_caens,
+    }
+
+
+def caen_sources_stat(sources: list[Path]) -> list[dict]:
+    return [
+        {
+            "name": source.name,
+            "size": source.stat().st_size,
+            "mtime_ns": source.stat().st_mtime_ns,
+        }
+        for source in sources
     ]
-    with mp.Pool() as pool:
-        results = pool.map(handle_one_caen, args_list)
-    all_caens = [result for result in results]
-    return all_caens
+
+
+def read_caens_cache(
+    cache_path: Path,
+    sources: list[Path],
+    processed_shots: int | str,
+    dtype,
+    channels: dict[int, list[int]] = None,
+) -> dict | None:
+    """
+    Загружает расшифрованный разряд из кэша через memory map
+    :param cache_path: папка кэша разряда
+    :param sources: msgpack файлы разряда
+    :param processed_shots: количество обработанных выстрелов
+    :param dtype: тип массива сигналов
+    :param channels: нужные каналы каенов, в кэше может быть больше каналов
+    :return: структура handle_all_caens(as_array=True) или None, если кэш устарел
+    """
+    index_path = cache_path / "index.json"
+    if not index_path.is_file():
+        return None
+
+    with open(index_path, "r") as index_file:
+        index = json.load(index_file)
+
+    if index["sources"] != caen_sources_stat(sources):
+        return None
+    if index["dtype"] != np.dtype(dtype).str:
+        return None
+
+    if str(processed_shots).lower() == "all":
+        if str(index["processed_shots"]).lower() != "all":
+            return None
+        processed_shots = index["shots"]
+    elif (
+        str(index["processed_shots"]).lower() != "all"
+        and processed_shots > index["processed_shots"]
+    ):
+        # в файлах могло оказаться меньше выстрелов, чем запрошено при записи,
+        # тогда запрос до index["processed_shots"] дает те же index["shots"]
+        return None
+
+    for caen in index["caens"]:
+        if channels is None:
+            required_channels = range(caen["channels_number"])
+        else:
+            required_channels = channels[caen["caen_num"]]
+        if not set(required_channels) <= set(caen["channels"]):
+            return None
+
+    all_caens = []
+    for caen in index["caens"]:
+        caen_data = np.load(cache_path / caen["signals"], mmap_mode="r")
+        max_positions = np.load(cache_path / caen["max_positions"])
+        shots_time = CaenTimeBase(
+            max_positions[:processed_shots],
+            index["t_step"],
+            index["time_shift"],
+            caen_data.shape[2],
+        )
+        all_caens.append(
+            {
+                "caen_num": caen["caen_num"],
+                "shots_time": shots_time,
+                "caen_channels": caen_data[:processed_shots],
+                "channels": caen["channels"],
+            }
+        )
+
+    return {
+        "combiscope_times": index["combiscope_times"][: processed_shots - 1],
+        "caens_data": all_caens,
+    }
+
+
+def write_caens_cache(
+    cache_path: Path,
+    sources: list[Path],
+    experiment_data: dict,
+    processed_shots: int | str,
+) -> None:
+    """
+    Записывает расшифрованные сигналы и привязку времени каенов в .npy.
+    Старый index.json удаляется первым, а новый пишется последним, поэтому
+    после сбоя на середине записи кэш просто не читается. Каждый .npy пишется
+    во временный файл и подменяется os.replace: открытые через memory map
+    старые файлы у читателей остаются целыми
+    """
+    cache_path.mkdir(parents=True, exist_ok=True)
+    channels_number = caen_msg_shape(sources[0], 1)[1]
+    (cache_path / "index.json").unlink(missing_ok=True)
+
+    caens = []
+    for caen in experiment_data["caens_data"]:
+        signals_name = f"caen_{caen['caen_num']}.npy"
+        max_positions_name = f"max_positions_{caen['caen_num']}.npy"
+        for name, array in (
+            (signals_name, caen["caen_channels"]),
+            (max_positions_name, caen["shots_time"].max_positions),
+        ):
+            temp_path = cache_path / f"{name}.tmp"
+            with open(temp_path, "wb") as array_file:
+                np.save(array_file, array)
+            os.replace(temp_path, cache_path / name)
+        caens.append(
+            {
+                "caen_num": caen["caen_num"],
+                "signals": signals_name,
+                "max_positions": max_positions_name,
+                "channels": caen["channels"],
+                "channels_number": channels_number,
+            }
+        )
+
+    index = {
+        "sources": caen_sources_stat(sources),
+        "processed_shots": processed_shots,
+        "shots": len(experiment_data["caens_data"][0]["caen_channels"]),
+        "dtype": experiment_data["caens_data"][0]["caen_channels"].dtype.str,
+        "t_step": experiment_data["caens_data"][0]["shots_time"].t_step,
+        "time_shift": experiment_data["caens_data"][0]["shots_time"].time_shift,
+        "combiscope_times": experiment_data["combiscope_times"],
+        "caens": caens,
+    }
+    temp_path = cache_path / "index.json.tmp"
+    with open(temp_path, "w") as index_file:
+        json.dump(index, index_file)
+    os.replace(temp_path, cache_path / "index.json")
+
+
+def handle_all_caens_cached(
+    discharge_num: str,
+    path: str,
+    processed_shots: int | str,
+    cache_path: Path = None,
+    multiprocess: bool = True,
+    dtype=np.float32,
+    channels: dict[int, list[int]] = None,
+) -> dict:
+    """
+    handle_all_caens с кэшем на диске: первый раз сигналы расшифровываются и пишутся
+    в cache_path, дальше открываются через memory map. Кэш сбрасывается при изменении
+    размера или времени изменения msgpack файлов.
+    :param discharge_num:
+    :param path:
+    :param processed_shots:
+    :param cache_path: папка кэша, по умолчанию path/discharge_num/decoded
+    :param multiprocess: расшифровывать файлы параллельно
+    :param dtype: тип массива сигналов
+    :param channels: {номер каена: номера каналов}, по умолчанию все каналы
+    :return:
+    """
+    msg_files_num_x10 = [0, 1, 2, 3]
+    sources = [
+        Path(path) / str(discharge_num) / f"{msg_num}.msgpk"
+        for msg_num in msg_files_num_x10
+    ]
+    if cache_path is None:
+        cache_path = Path(path) / str(discharge_num) / "decoded"
+
+    try:
+        experiment_data = read_caens_cache(
+            cache_path, sources, processed_shots, dtype, channels
+        )
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Decoded cache of {discharge_num} is broken, {e}")
+        experiment_data = None
+    if experiment_data is not None:
+        return experiment_data
+
+    if multiprocess:
+        experiment_data = handle_all_caens_multiproces(
+            discharge_num=discharge_num,
+            path=path,
+            processed_shots=processed_shots,
+            msg_list=msg_files_num_x10,
+            dtype=dtype,
+            channels=channels,
+        )
+    else:
+        experiment_data = handle_all_caens(
+            discharge_num=discharge_num,
+            path=path,
+            processed_shots=processed_shots,
+            as_array=True,
+            dtype=dtype,
+            channels=channels,
+        )
+
+    try:
+        write_caens_cache(cache_path, sources, experiment_data, processed_shots)
+    except OSError as e:
+        print(f"Decoded cache of {discharge_num} was not written, {e}")
+
+    return experiment_data
 
 
 if __name__ == "__main__":
@@ -107,11 +620,9 @@ if __name__ == "__main__":
         all_caens = handle_all_caens(
             discharge_num=discharge_number, path=path_data, processed_shots=30
         )
-        msg_list = [0, 1, 2, 3]
         all_caens_2 = handle_all_caens_multiproces(
             discharge_num=discharge_number,
             path=path_data,
-            msg_list=msg_list,
             processed_shots="all",
         )
 
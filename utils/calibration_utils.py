@@ -3,9 +3,12 @@ import math
 import os
 import statistics
 
+import numpy as np
+
 from calibrations.spectral_calibration.spectral_calibration import (
     get_avalanche_data_amper, get_avalanche_data_phe, get_filters_data)
 from utils.POLY_v2 import Polychromator
+from utils.signal_processing import get_signal_windows, get_window_sums
 
 
 def linear_interpolation(x_point: float, Xdata: list, Ydata: list) -> float:
@@ -73,26 +76,12 @@ def get_raman_wl_section(
 
 def get_calibration_integrals(poly: Polychromator, t_step: float = 0.325) -> list:
     all_const = poly.gain.resulting_multiplier
-    all_shots_signal = []
-    for shot in range(0, len(poly.signals[0])):
-
-        for poly_ch in range(1):
-            signal_indices = [
-                bisect.bisect_left(
-                    poly.signals_time[shot], poly.config[poly_ch]["sig_LeftBord"]
-                ),
-                bisect.bisect_right(
-                    poly.signals_time[shot], poly.config[poly_ch]["sig_RightBord"]
-                ),
-            ]
+    left_ind, right_ind, _ = get_signal_windows(poly.signals_time, poly.config[:1])
 
-            signal_integral = (
-                sum(poly.signals[poly_ch][shot][signal_indices[0] : signal_indices[1]])
-                * t_step
-            )
-            all_shots_signal.append(signal_integral * all_const)
-
-    return all_shots_signal
+    window_sums = get_window_sums(
+        np.asarray(poly.get_waveforms()[:, :1], dtype=float), left_ind, right_ind
+    )
+    return list(window_sums[:, 0] * t_step * all_const)
 
 
 def get_ophir_data(ophir_path: str, ophir_shot_name) -> list:
@@ -1,6 +1,20 @@
 import json
+import os
+import warnings
 from pathlib import Path
 
+import numpy as np
+
+FE_TABLE_SUFFIX = ".fe"
+FE_TABLE_MAGIC = b"DDTR_FE1"
+FE_TABLE_ALIGN = 64
+# корень репозитория, пути по умолчанию не зависят от рабочей папки
+REPO_PATH = Path(__file__).resolve().parents[1]
+AVALANCHE_PATH = REPO_PATH / "calibrations/calibration_datasheets/aw_hama.csv"
+SCATTERING_ANGLE = 110
+# сетка Te (эВ) таблиц T15: как у исходной f_expected_t15_june2024, до 1500 эВ
+T15_TE_GRID = [1 + 0.5 * step for step in range(3000)]
+
 
 class GainsEquator:
     def setup(self):
@@ -67,19 +81,260 @@ class Gains_T15_35(Gains_T15_34):
         self.setup()
 
 
+def _as_float_array(array) -> np.ndarray:
+    # memmap из FeTable.load не копируется в память
+    if isinstance(array, np.memmap):
+        return array
+    return np.array(array, dtype=float)
+
+
+class FeTable:
+    """
+    Таблица ожидаемых сигналов каналов f_e(Te) для одного типа полихроматора.
+    Массивы только для чтения: одна таблица делится между всеми полихроматорами
+    """
+
+    def __init__(self, te_grid, fe, wl_grid=None, metadata: dict = None):
+        """
+        :param te_grid: сетка Te, эВ, по возрастанию
+        :param fe: ожидаемые сигналы каналов (Te, ch)
+        :param wl_grid: сетка длин волн, по которой считались fe
+        :param metadata: происхождение таблицы: файлы фильтров и диода, угол и т.д.
+        fe_derivative - dfe/dTe (Te, ch), считается один раз на таблицу
+        """
+        self.te_grid = _as_float_array(te_grid)
+        self.fe = _as_float_array(fe)
+        self.wl_grid = None if wl_grid is None else _as_float_array(wl_grid)
+        self.metadata = dict(metadata or {})
+        if self.fe.shape[0] != self.te_grid.size:
+            raise ValueError(
+                f"fe has {self.fe.shape[0]} rows, Te grid has {self.te_grid.size} points"
+            )
+
+        # производная вперед, у последней точки сетки соседа нет
+        self.fe_derivative = np.full(self.fe.shape, np.nan)
+        self.fe_derivative[:-1] = (
+            np.diff(self.fe, axis=0) / np.diff(self.te_grid)[:, None]
+        )
+
+        for array in (self.te_grid, self.fe, self.fe_derivative, self.wl_grid):
+            if array is not None:
+                array.flags.writeable = False
+
+        steps = np.diff(self.te_grid)
+        if steps.size and np.allclose(steps, steps[0], rtol=1e-6, atol=0):
+            self.te_step = float(steps[0])
+        else:
+            self.te_step = None
+
+    @classmethod
+    def from_dict(cls, fe_data: dict) -> "FeTable":
+        """
+        :param fe_data: словарь из f_expected json: wl_grid, Te_grid и строки Te
+        """
+        fe = [f_e for T_e, f_e in fe_data.items() if T_e not in ("wl_grid", "Te_grid")]
+        return cls(fe_data["Te_grid"], fe, fe_data.get("wl_grid"))
+
+    def save(self, path: Path):
+        """
+        Бинарная таблица: FE_TABLE_MAGIC, длина заголовка (uint64), JSON заголовок
+        с размерами и metadata, дальше с выравниванием на FE_TABLE_ALIGN
+        float64 little-endian: сетка Te, fe (Te, ch), сетка длин волн
+        """
+        header = {
+            "te_number": len(self),
+            "ch_number": self.ch_number,
+            "wl_number": 0 if self.wl_grid is None else self.wl_grid.size,
+            "metadata": self.metadata,
+        }
+        header = json.dumps(header).encode()
+        prefix_len = len(FE_TABLE_MAGIC) + 8
+        data_offset = -(-(prefix_len + len(header)) // FE_TABLE_ALIGN) * FE_TABLE_ALIGN
+        header = header.ljust(data_offset - prefix_len)
+
+        path = Path(path)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as fe_file:
+            fe_file.write(FE_TABLE_MAGIC)
+            fe_file.write(len(header).to_bytes(8, "little"))
+            fe_file.write(header)
+            for array in (self.te_grid, self.fe, self.wl_grid):
+                if array is not None:
+                    fe_file.write(np.ascontiguousarray(array, dtype="<f8").tobytes())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Path, mmap: bool = True) -> "FeTable":
+        """
+        Чтение таблицы FeTable.save
+        :param mmap: открыть массивы через memmap, без чтения файла целиком
+        """
+        with open(path, "rb") as fe_file:
+            if fe_file.read(len(FE_TABLE_MAGIC)) != FE_TABLE_MAGIC:
+                raise ValueError(f"{path} is not an fe table")
+            header_len = int.from_bytes(fe_file.read(8), "little")
+            header = json.loads(fe_file.read(header_len))
+
+        te_number, ch_number = header["te_number"], header["ch_number"]
+        fe_end = te_number * (1 + ch_number)
+        size = fe_end + header["wl_number"]
+        data_offset = len(FE_TABLE_MAGIC) + 8 + header_len
+        if mmap:
+            data = np.memmap(path, "<f8", "r", offset=data_offset, shape=(size,))
+        else:
+            data = np.fromfile(path, "<f8", count=size, offset=data_offset)
+
+        return cls(
+            data[:te_number],
+            data[te_number:fe_end].reshape(te_number, ch_number),
+            data[fe_end:] if header["wl_number"] else None,
+            header["metadata"],
+        )
+
+    def __len__(self):
+        return self.te_grid.size
+
+    @property
+    def ch_number(self) -> int:
+        return self.fe.shape[1]
+
+    def get_index(self, T_e):
+        """
+        Индекс ближайшей точки сетки, для равномерной сетки за O(1)
+        :param T_e: Te, число, строка или массив
+        :return: индекс или массив индексов
+        """
+        if isinstance(T_e, str):
+            T_e = float(T_e)
+        T_e = np.asarray(T_e, dtype=float)
+
+        if self.te_step is not None:
+            ind = np.rint((T_e - self.te_grid[0]) / self.te_step).astype(int)
+        else:
+            ind = np.searchsorted(self.te_grid, T_e)
+            ind = np.clip(ind, 1, len(self) - 1)
+            ind -= T_e - self.te_grid[ind - 1] < self.te_grid[ind] - T_e
+
+        if np.any((ind < 0) | (ind >= len(self))):
+            raise IndexError(f"Te={T_e} is out of the grid")
+        return ind if ind.ndim else int(ind)
+
+
 class ExpectedFe:
-    def __init__(self, equator_poly_path: Path = None, t15_poly_path: Path = None):
+    _loaded = {}
+
+    def __init__(
+        self,
+        equator_poly_path: Path = None,
+        t15_poly_path: Path = None,
+        avalanche_path: Path = AVALANCHE_PATH,
+        equator_te_grid: list = None,
+        t15_te_grid: list = T15_TE_GRID,
+    ):
+        """
+        :param equator_te_grid: сетка Te для csv фильтров экватора, None - get_default_grids
+        :param t15_te_grid: сетка Te для csv фильтров T15
+        """
+        self.avalanche_path = avalanche_path
+        # (таблица, откуда она, сетка Te), чтобы для волокна найти файл его фильтров
+        self.sources = []
+
         if equator_poly_path:
-            self.equator_fe = self.load_fe_expected(equator_poly_path)
+            self.equator_fe = self.load_fe_expected(
+                equator_poly_path, avalanche_path, equator_te_grid
+            )
+            self.sources.append(
+                (self.equator_fe, Path(equator_poly_path), equator_te_grid)
+            )
 
         if t15_poly_path:
-            self.t15_fe = self.load_fe_expected(t15_poly_path)
+            self.t15_fe = self.load_fe_expected(
+                t15_poly_path, avalanche_path, t15_te_grid
+            )
+            self.sources.append((self.t15_fe, Path(t15_poly_path), t15_te_grid))
+
+    def get_fibers_fe(
+        self, fibers_fe: dict, angles: dict = None, processes: int = None
+    ) -> dict:
+        """
+        Своя таблица для каждого волокна по его углу рассеяния.
+        Для типов полихроматоров, заданных csv фильтров, таблицы всех волокон
+        считаются вызовом get_fe_tables на сетке Te своего типа. Готовые таблицы
+        (fe, json) посчитаны для SCATTERING_ANGLE и остаются общими, другой угол
+        для них дает предупреждение
+        :param fibers_fe: {волокно: общая таблица его типа, equator_fe или t15_fe}
+        :param angles: {волокно: угол рассеяния, градусы}, по умолчанию SCATTERING_ANGLE
+        :param processes: число процессов для get_fe_tables
+        :return: {волокно: FeTable}
+        """
+        angles = angles or {}
+        result = {}
+        tasks = {}
+        for fiber, fe_table in fibers_fe.items():
+            angle = angles.get(fiber, SCATTERING_ANGLE)
+            source, te_grid = next(
+                (
+                    (path, te_grid)
+                    for table, path, te_grid in self.sources
+                    if table is fe_table
+                ),
+                (None, None),
+            )
+            if source is not None and source.suffix == ".csv":
+                grid_key = None if te_grid is None else tuple(te_grid)
+                tasks.setdefault(grid_key, []).append((fiber, angle, source))
+                continue
+            if angle != SCATTERING_ANGLE:
+                warnings.warn(
+                    f"{fiber}: fe table {source} is precomputed for "
+                    f"{SCATTERING_ANGLE} deg, scattering angle {angle} deg is ignored, "
+                    f"point the polychromator type at its filter csv instead"
+                )
+            result[fiber] = fe_table
+
+        if tasks:
+            from utils.expected_fe import get_fe_tables
+
+            for grid_key, grid_tasks in tasks.items():
+                result.update(
+                    get_fe_tables(
+                        self.avalanche_path,
+                        grid_tasks,
+                        te_grid=grid_key,
+                        processes=processes,
+                    )
+                )
+        return result
 
     @staticmethod
-    def load_fe_expected(path: Path):
-        with open(path, "r") as f_file:
-            fe_data = json.load(f_file)
-        return fe_data
+    def load_fe_expected(
+        path: Path, avalanche_path: Path = AVALANCHE_PATH, te_grid: list = None
+    ) -> FeTable:
+        """
+        Таблица читается один раз на файл, повторные вызовы отдают ту же FeTable,
+        пока файл не изменился
+        :param path: бинарная таблица FE_TABLE_SUFFIX, f_expected json или csv фильтров,
+        для csv таблица считается по требованию через кэш get_fe_table
+        :param avalanche_path: чувствительность диода для csv фильтров
+        :param te_grid: сетка Te для csv фильтров, None - get_default_grids
+        """
+        if Path(path).suffix == ".csv":
+            from utils.expected_fe import get_fe_table
+
+            return get_fe_table(avalanche_path, path, te_grid=te_grid)
+
+        path = Path(path).resolve()
+        key = (path, path.stat().st_mtime_ns)
+        if key not in ExpectedFe._loaded:
+            for old_key in [k for k in ExpectedFe._loaded if k[0] == path]:
+                del ExpectedFe._loaded[old_key]
+            if path.suffix == FE_TABLE_SUFFIX:
+                ExpectedFe._loaded[key] = FeTable.load(path)
+            else:
+                with open(path, "r") as f_file:
+                    fe_data = json.load(f_file)
+                ExpectedFe._loaded[key] = FeTable.from_dict(fe_data)
+        return ExpectedFe._loaded[key]
 
 
 class LaserNdYag:
@@ -1,72 +1,350 @@
+import hashlib
 import json
-import math
+import multiprocessing as mp
+import os
+from pathlib import Path
+
+import numpy as np
 
 from calibrations.spectral_calibration.spectral_calibration import (
-    get_avalanche_data_amper, get_avalanche_data_phe, get_filters_data,
-    linear_interpolation)
+    get_avalanche_data_amper, get_avalanche_data_phe, get_filters_data)
+from utils.diagnostic_utils import FE_TABLE_SUFFIX, REPO_PATH, FeTable
+
+FE_CACHE_PATH = REPO_PATH / "config/fe_cache"
+FE_CACHE_SIZE = 32
+
+
+def get_selden_wl_terms(
+    wl_grid: list | np.ndarray, theta_deg: float, lambda_0: float
+) -> (np.ndarray, np.ndarray):
+    """
+    Части формулы Сельдена, зависящие только от длины волны, считаются один раз
+    :param wl_grid: сетка длин волн, нм
+    :param theta_deg: угол рассеяния, градусы
+    :param lambda_0: длина волны лазера, нм
+    :return: a_loc и b_loc (wl,)
+    """
+    theta = theta_deg * np.pi / 180.0
+    x = np.asarray(wl_grid, dtype=float) / lambda_0 - 1
+    a_loc = (1 + x) ** 3 * np.sqrt(2 * (1 - np.cos(theta)) * (1 + x) + x**2)
+    b_loc = np.sqrt(1 + x * x / (2 * (1 - np.cos(theta)) * (1 + x))) - 1
+    return a_loc, b_loc
 
 
 def spect_dens_selden(
-    temperature: float, wl_grid: list, theta_deg: float, lambda_0: float
-) -> list:
+    temperature: float | np.ndarray,
+    wl_grid: list | np.ndarray,
+    theta_deg: float,
+    lambda_0: float,
+    wl_terms: tuple[np.ndarray, np.ndarray] = None,
+) -> np.ndarray:
+    """
+    Спектральная плотность рассеяния по Сельдену сразу для всей сетки (Te, wl)
+    :param temperature: Te, эВ, число или массив (Te,)
+    :param wl_grid: сетка длин волн, нм
+    :param theta_deg: угол рассеяния, градусы
+    :param lambda_0: длина волны лазера, нм
+    :param wl_terms: готовые get_selden_wl_terms для той же сетки
+    :return: (wl,) для числа, (Te, wl) для массива Te
+    """
     # деление на lambda_0 - нормировка интеграла при переходе к нужной длине волны
 
     m_e = 9.1e-31
     c_light = 3e8
     q_elec = 1.6e-19
 
+    if wl_terms is None:
+        wl_terms = get_selden_wl_terms(wl_grid, theta_deg, lambda_0)
+    a_loc, b_loc = wl_terms
+
     alphaT = m_e * c_light * c_light / (2 * q_elec)
-    theta = theta_deg * math.pi / 180.0
-    alpha = alphaT / temperature
-    section = []
-    for wl in wl_grid:
-        x = (wl / lambda_0) - 1
-        a_loc = math.pow(1 + x, 3) * math.sqrt(
-            2 * (1 - math.cos(theta)) * (1 + x) + math.pow(x, 2)
-        )
-        b_loc = math.sqrt(1 + x * x / (2 * (1 - math.cos(theta)) * (1 + x))) - 1
-        c_loc = math.sqrt(alpha / math.pi) * (
-            1 - (15 / (16 * alpha)) + 345 / (512 * alpha * alpha)
-        )
-        section.append(
-            (c_loc / a_loc) * math.exp(-2 * alpha * b_loc) / (lambda_0 * 1e-9)
-        )  # to meters
-    return section
+    alpha = alphaT / np.asarray(temperature, dtype=float)[..., None]
+    c_loc = np.sqrt(alpha / np.pi) * (
+        1 - (15 / (16 * alpha)) + 345 / (512 * alpha * alpha)
+    )
+    return (c_loc / a_loc) * np.exp(-2 * alpha * b_loc) / (lambda_0 * 1e-9)  # to meters
 
 
-def f_e_calc(avalanche_Path, filter_Path):
-    avalanche_wl, avalanche = get_avalanche_data_amper(avalanche_Path)
-    filters_wl, filters_transm = get_filters_data(filter_Path, filters_transposed=True)
+def get_quadrature_weights(
+    wl_grid: list | np.ndarray, quadrature: str = "rectangle"
+) -> np.ndarray:
+    """
+    Веса квадратуры по сетке длин волн, в метрах
+    :param wl_grid: сетка длин волн, нм
+    :param quadrature: "rectangle" (шаг сетки, как раньше) или "trapezoid"
+    :return: (wl,)
+    """
+    wl_grid = np.asarray(wl_grid, dtype=float)
+    wl_diff = np.diff(wl_grid)
+    if quadrature == "rectangle":
+        weights = np.full(wl_grid.shape, wl_diff.mean())
+    elif quadrature == "trapezoid":
+        weights = np.zeros(wl_grid.shape)
+        weights[:-1] += wl_diff / 2
+        weights[1:] += wl_diff / 2
+    else:
+        raise ValueError(f"Unknown quadrature: {quadrature}")
+    return weights * 1e-9
+
 
+def get_weight_matrix(
+    wl_grid: list | np.ndarray,
+    avalanche_wl: list,
+    avalanche: list,
+    filters_wl: list,
+    filters_transm: list,
+    quadrature: str = "rectangle",
+) -> np.ndarray:
+    """
+    Матрица весов фильтр * детектор / lambda * шаг квадратуры
+    :param wl_grid: сетка длин волн, нм
+    :param avalanche_wl: длины волн чувствительности диода
+    :param avalanche: чувствительность диода
+    :param filters_wl: длины волн пропускания фильтров
+    :param filters_transm: пропускание фильтров, (ch, wl) как в get_filters_data
+    :param quadrature: "rectangle" или "trapezoid"
+    :return: (wl, ch)
+    """
+    wl_grid = np.asarray(wl_grid, dtype=float)
+    detector = np.interp(wl_grid, avalanche_wl, avalanche)
+    filters = np.array(
+        [np.interp(wl_grid, filters_wl, filt) for filt in filters_transm]
+    )
+    weights = detector / (wl_grid * 1e-9) * get_quadrature_weights(wl_grid, quadrature)
+    return (filters * weights).T
+
+
+def get_default_grids() -> (list, list):
+    """
+    Сетки длин волн (нм) и Te (эВ), на которых считаются таблицы f_e_calc
+    """
     wl_step = 0.2
     wl_grid = [700 + wl_step * step_count for step_count in range(1825)]
     Te_grid = [1 + 0.2 * step for step in range(5000)]
+    return wl_grid, Te_grid
 
-    avalanche_aw_interpolation = [
-        linear_interpolation(wl, avalanche_wl, avalanche) for wl in wl_grid
-    ]
-    filters_interpolation = []
 
-    for filter in filters_transm:
-        filters_interpolation.append(
-            [linear_interpolation(wl, filters_wl, filter) for wl in wl_grid]
+def f_e_calc(
+    avalanche_Path,
+    filter_Path: str | list[str],
+    quadrature: str = "rectangle",
+    theta_deg: float = 110,
+    lambda_0: float = 1064.4,
+    save_path: Path | list[Path] = None,
+    te_grid: list = None,
+) -> dict | list[dict]:
+    """
+    Ожидаемые интегралы сечения рассеяния по каналам полихроматора.
+    Интеграл по длинам волн - одно матричное произведение (Te, wl) @ (wl, ch)
+    :param avalanche_Path: чувствительность лавинного диода, А/Вт
+    :param filter_Path: файл пропускания фильтров или список файлов для нескольких полихроматоров
+    :param quadrature: "rectangle" или "trapezoid"
+    :param theta_deg: угол рассеяния, градусы
+    :param lambda_0: длина волны лазера, нм
+    :param save_path: куда записать бинарные FeTable, по одному на файл фильтров
+    :param te_grid: сетка Te, эВ, по умолчанию из get_default_grids
+    :return: словарь {"wl_grid", "Te_grid", Te: [каналы]} или список таких словарей
+    """
+    single = isinstance(filter_Path, (str, Path))
+    filter_Paths = [filter_Path] if single else filter_Path
+    if save_path is not None and isinstance(save_path, (str, Path)):
+        save_path = [save_path]
+
+    avalanche_wl, avalanche = get_avalanche_data_amper(avalanche_Path)
+
+    wl_grid, Te_grid = get_default_grids()
+    if te_grid is not None:
+        Te_grid = list(te_grid)
+
+    weights = []
+    for path in filter_Paths:
+        filters_wl, filters_transm = get_filters_data(path, filters_transposed=True)
+        weights.append(
+            get_weight_matrix(
+                wl_grid, avalanche_wl, avalanche, filters_wl, filters_transm, quadrature
+            )
         )
 
-    result = {"wl_grid": wl_grid, "Te_grid": Te_grid}
+    sections = spect_dens_selden(np.array(Te_grid), wl_grid, theta_deg, lambda_0)
+    all_fe = sections @ np.concatenate(weights, axis=1)
+    split = np.cumsum([weight.shape[1] for weight in weights])[:-1]
+
+    results = []
+    for ind, fe in enumerate(np.split(all_fe, split, axis=1)):
+        result = {"wl_grid": wl_grid, "Te_grid": Te_grid}
+        result.update(zip(Te_grid, fe.tolist()))
+        results.append(result)
 
-    for T in Te_grid:
-        section = spect_dens_selden(T, wl_grid, 110, 1064.4)
-        all_filters = []
-        for filter in filters_interpolation:
-            integral = 0
-            for wl, sec, detector, filter_trans in zip(
-                wl_grid, section, avalanche_aw_interpolation, filter
-            ):
-                integral += sec * filter_trans * detector / (wl * 1e-9)
-            all_filters.append(integral * wl_step * 1e-9)
-        result[T] = all_filters
+        if save_path is not None:
+            metadata = {
+                "avalanche": Path(avalanche_Path).name,
+                "filters": Path(filter_Paths[ind]).name,
+                "theta_deg": theta_deg,
+                "lambda_0": lambda_0,
+                "quadrature": quadrature,
+            }
+            FeTable(Te_grid, fe, wl_grid, metadata).save(save_path[ind])
 
-    return result
+    return results[0] if single else results
+
+
+def get_fe_cache_key(
+    avalanche_Path,
+    filter_Path,
+    theta_deg: float,
+    lambda_0: float,
+    quadrature: str = "rectangle",
+    te_grid: list = None,
+) -> str:
+    """
+    Хэш всего, от чего зависит таблица: содержимое файлов диода и фильтров,
+    угол, длина волны лазера, квадратура и сетки
+    :param te_grid: сетка Te, None - из get_default_grids
+    """
+    key = hashlib.sha1()
+    for path in (avalanche_Path, filter_Path):
+        with open(path, "rb") as data_file:
+            key.update(data_file.read())
+    key.update(json.dumps([theta_deg, lambda_0, quadrature]).encode())
+    wl_grid, Te_grid = get_default_grids()
+    if te_grid is not None:
+        Te_grid = te_grid
+    for grid in (wl_grid, Te_grid):
+        key.update(np.array(grid, dtype=float).tobytes())
+    return key.hexdigest()
+
+
+def evict_fe_cache(cache_path: Path = FE_CACHE_PATH, cache_size: int = FE_CACHE_SIZE):
+    """
+    Удаление давно не использованных таблиц, в кэше остается cache_size последних
+    """
+    tables = sorted(
+        Path(cache_path).glob(f"*{FE_TABLE_SUFFIX}"),
+        key=lambda table_path: table_path.stat().st_mtime,
+        reverse=True,
+    )
+    for table_path in tables[cache_size:]:
+        try:
+            table_path.unlink()
+        except OSError:
+            # таблица открыта через memmap (Windows), удалится в следующий раз
+            pass
+
+
+def fe_calc_chunk(args):
+    """
+    Один угол рассеяния для пула процессов: одно сечение и одно матричное
+    произведение на все файлы фильтров с этим углом, таблицы пишутся в кэш
+    :param args: (avalanche_Path, filter_Paths, theta_deg, lambda_0, quadrature,
+    save_paths, te_grid)
+    """
+    (
+        avalanche_Path,
+        filter_Paths,
+        theta_deg,
+        lambda_0,
+        quadrature,
+        save_paths,
+        te_grid,
+    ) = args
+    f_e_calc(
+        avalanche_Path,
+        filter_Paths,
+        quadrature,
+        theta_deg,
+        lambda_0,
+        save_path=save_paths,
+        te_grid=te_grid,
+    )
+
+
+def get_fe_tables(
+    avalanche_Path,
+    tasks: list[tuple],
+    lambda_0: float = 1064.4,
+    quadrature: str = "rectangle",
+    cache_path: Path = FE_CACHE_PATH,
+    cache_size: int = FE_CACHE_SIZE,
+    processes: int = None,
+    te_grid: list = None,
+) -> dict:
+    """
+    Таблицы для набора волокон за один вызов: недостающие в кэше таблицы
+    группируются по углу и считаются в пуле процессов, по fe_calc_chunk на угол.
+    Волокна с одинаковыми углом и фильтрами получают одну и ту же FeTable
+    :param tasks: список (волокно, угол рассеяния в градусах, файл фильтров)
+    :param processes: число процессов, 1 - без пула
+    :param te_grid: сетка Te всех таблиц, None - из get_default_grids
+    :return: {волокно: FeTable}
+    """
+    table_paths = {}
+    missing = {}
+    for fiber, theta_deg, filter_Path in tasks:
+        key = get_fe_cache_key(
+            avalanche_Path, filter_Path, theta_deg, lambda_0, quadrature, te_grid
+        )
+        table_path = Path(cache_path) / f"{key}{FE_TABLE_SUFFIX}"
+        table_paths[fiber] = table_path
+        if table_path.is_file():
+            # время изменения - время последнего использования для вытеснения
+            os.utime(table_path)
+        else:
+            missing.setdefault(theta_deg, {})[table_path] = filter_Path
+
+    args_list = [
+        (
+            avalanche_Path,
+            list(paths.values()),
+            theta_deg,
+            lambda_0,
+            quadrature,
+            list(paths),
+            te_grid,
+        )
+        for theta_deg, paths in missing.items()
+    ]
+    if args_list:
+        os.makedirs(cache_path, exist_ok=True)
+        if processes is None:
+            processes = min(len(args_list), mp.cpu_count())
+        if processes > 1:
+            with mp.Pool(processes=processes) as pool:
+                pool.map(fe_calc_chunk, args_list)
+        else:
+            for args in args_list:
+                fe_calc_chunk(args)
+        evict_fe_cache(cache_path, max(cache_size, len(set(table_paths.values()))))
+
+    tables = {path: FeTable.load(path) for path in set(table_paths.values())}
+    return {fiber: tables[path] for fiber, path in table_paths.items()}
+
+
+def get_fe_table(
+    avalanche_Path,
+    filter_Path,
+    theta_deg: float = 110,
+    lambda_0: float = 1064.4,
+    quadrature: str = "rectangle",
+    cache_path: Path = FE_CACHE_PATH,
+    cache_size: int = FE_CACHE_SIZE,
+    te_grid: list = None,
+) -> FeTable:
+    """
+    Таблица f_e_calc по требованию: лежит в кэше под хэшем get_fe_cache_key,
+    поэтому изменение файла фильтров дает новую таблицу, а старая вытесняется
+    :param cache_path: папка кэша
+    :param cache_size: сколько таблиц держать в кэше
+    """
+    return get_fe_tables(
+        avalanche_Path,
+        [(None, theta_deg, filter_Path)],
+        lambda_0,
+        quadrature,
+        cache_path,
+        cache_size,
+        processes=1,
+        te_grid=te_grid,
+    )[None]
 
 
 if __name__ == "__main__":
@@ -74,7 +352,5 @@ if __name__ == "__main__":
     avalanche_Path = r"..\calibrations\calibration_datasheets\aw_hama.csv"
     filter_Path = r"..\calibrations\calibration_datasheets\filters_equator.csv"
 
-    f_e = f_e_calc(avalanche_Path, filter_Path)
-
-    with open("../config/f_expected_equator_june2024_v3.json", "w") as f_file:
-        json.dump(f_e, f_file, indent=4)
+    # таблица попадает в кэш FE_CACHE_PATH, оттуда ее берет ExpectedFe
+    fe_table = get_fe_table(avalanche_Path, filter_Path)
@@ -0,0 +1,381 @@
+import numpy as np
+
+
+def get_chi_squared(
+    phe: np.ndarray, noise: np.ndarray, response: np.ndarray
+) -> np.ndarray:
+    """
+    chi^2 всех выстрелов для всех точек сетки Te за одно матричное умножение.
+    Амплитуда (плотность) для каждой Te берется оптимальной:
+    chi^2 = sum(S^2/n^2) - sum_1^2 / sum_2,
+    sum_1 = sum(S * F / n^2), sum_2 = sum(F^2 / n^2)
+    :param phe: фотоэлектроны (..., ch)
+    :param noise: шум фотоэлектронов (..., ch)
+    :param response: ожидаемые сигналы с учетом спектральной калибровки (Te, ch)
+    :return: chi^2 (..., Te)
+    """
+    weight = 1 / np.asarray(noise, dtype=float) ** 2
+    phe = np.asarray(phe, dtype=float)
+    sum_1 = (phe * weight) @ response.T
+    sum_2 = weight @ (response**2).T
+    return np.sum(phe**2 * weight, axis=-1)[..., None] - sum_1**2 / sum_2
+
+
+def fit_temperature(
+    phe: np.ndarray,
+    noise: np.ndarray,
+    response: np.ndarray,
+    stride: int = 1,
+    candidates: int = 3,
+) -> (np.ndarray, np.ndarray):
+    """
+    Перебор сетки Te сразу для всех выстрелов.
+    При stride > 1 сначала перебирается каждая stride-я точка сетки, затем
+    полная сетка только в окнах +-stride вокруг candidates лучших грубых точек.
+    Это эвристика: узкий глобальный минимум между грубыми точками может быть
+    пропущен, точный результат дает только stride = 1
+    :param phe: фотоэлектроны (..., ch)
+    :param noise: шум фотоэлектронов (..., ch)
+    :param response: ожидаемые сигналы с учетом спектральной калибровки (Te, ch)
+    :param stride: прореживание сетки на грубом проходе, 1 - полный перебор
+    :param candidates: число грубых минимумов, вокруг которых идет точный перебор
+    :return: индекс Te с минимальным chi^2 (...) и сам минимум chi^2 (...)
+    """
+    te_number = response.shape[0]
+    if stride <= 1 or te_number <= 2 * stride * candidates:
+        chi = get_chi_squared(phe, noise, response)
+        te_ind = np.argmin(chi, axis=-1)
+        return te_ind, np.take_along_axis(chi, te_ind[..., None], axis=-1)[..., 0]
+
+    phe = np.asarray(phe, dtype=float)
+    noise = np.asarray(noise, dtype=float)
+    coarse_ind = np.arange(0, te_number, stride)
+    if coarse_ind[-1] != te_number - 1:
+        coarse_ind = np.append(coarse_ind, te_number - 1)
+    coarse_chi = get_chi_squared(phe, noise, response[coarse_ind])
+    candidates = min(candidates, coarse_ind.size)
+    best = np.argpartition(coarse_chi, candidates - 1, axis=-1)[..., :candidates]
+
+    # (..., candidates * (2 * stride + 1)) индексов полной сетки
+    offsets = np.arange(-stride, stride + 1)
+    window_ind = coarse_ind[best][..., None] + offsets
+    window_ind = np.clip(window_ind, 0, te_number - 1).reshape(best.shape[:-1] + (-1,))
+
+    weight = 1 / noise**2
+    rows = response[window_ind]
+    sum_1 = np.matmul(rows, (phe * weight)[..., None])[..., 0]
+    sum_2 = np.matmul(rows**2, weight[..., None])[..., 0]
+    chi = np.sum(phe**2 * weight, axis=-1)[..., None] - sum_1**2 / sum_2
+    best = np.argmin(chi, axis=-1)[..., None]
+    # равные chi^2 как в полном переборе: берется меньший индекс
+    chi_min = np.take_along_axis(chi, best, axis=-1)[..., 0]
+    te_ind = np.min(np.where(chi == chi_min[..., None], window_ind, te_number), axis=-1)
+
+    # nan в окне (нулевые шумы, пустая таблица) - такие выстрелы полным перебором
+    failed = te_ind == te_number
+    if np.any(failed):
+        te_ind[failed], chi_min[failed] = fit_temperature(
+            phe[failed], noise[failed], response
+        )
+    return te_ind, chi_min
+
+
+def interpolate_response(
+    te_grid: np.ndarray, response: np.ndarray, te: np.ndarray
+) -> np.ndarray:
+    """
+    Ожидаемые сигналы каналов между точками сетки Te.
+    Положительные значения интерполируются линейно по логарифму (хвосты f_e
+    спадают экспоненциально), нули - линейно
+    :param te_grid: сетка Te по возрастанию
+    :param response: ожидаемые сигналы на сетке (Te, ch)
+    :param te: Te, число или массив (...)
+    :return: ожидаемые сигналы (..., ch)
+    """
+    te = np.asarray(te, dtype=float)
+    ind = np.clip(np.searchsorted(te_grid, te, side="right") - 1, 0, te_grid.size - 2)
+    weight = ((te - te_grid[ind]) / (te_grid[ind + 1] - te_grid[ind]))[..., None]
+    left, right = response[ind], response[ind + 1]
+
+    linear = left + (right - left) * weight
+    positive = (left > 0) & (right > 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        logarithmic = left * (right / left) ** weight
+    return np.where(positive, logarithmic, linear)
+
+
+def get_chi_squared_at(
+    phe: np.ndarray, noise: np.ndarray, expected: np.ndarray
+) -> np.ndarray:
+    """
+    chi^2 при своих ожидаемых сигналах для каждого выстрела
+    :param phe: фотоэлектроны (..., ch)
+    :param noise: шум фотоэлектронов (..., ch)
+    :param expected: ожидаемые сигналы (..., ch)
+    :return: chi^2 (...)
+    """
+    weight = 1 / np.asarray(noise, dtype=float) ** 2
+    phe = np.asarray(phe, dtype=float)
+    sum_1 = np.sum(phe * expected * weight, axis=-1)
+    sum_2 = np.sum(expected**2 * weight, axis=-1)
+    return np.sum(phe**2 * weight, axis=-1) - sum_1**2 / sum_2
+
+
+def refine_temperature(
+    phe: np.ndarray,
+    noise: np.ndarray,
+    te_grid: np.ndarray,
+    response: np.ndarray,
+    te_ind: np.ndarray,
+    te_tolerance: float = 1e-3,
+) -> np.ndarray:
+    """
+    Уточнение Te между точками сетки: золотое сечение chi^2 на отрезке
+    между соседями найденной перебором точки, f_e интерполируются
+    :param phe: фотоэлектроны (..., ch)
+    :param noise: шум фотоэлектронов (..., ch)
+    :param te_grid: сетка Te по возрастанию
+    :param response: ожидаемые сигналы на сетке (Te, ch)
+    :param te_ind: индексы минимума chi^2 на сетке из fit_temperature (...)
+    :param te_tolerance: требуемая точность Te, эВ
+    :return: Te (...)
+    """
+    te_ind = np.asarray(te_ind)
+    left = te_grid[np.maximum(te_ind - 1, 0)]
+    right = te_grid[np.minimum(te_ind + 1, te_grid.size - 1)]
+
+    def chi_squared(te):
+        return get_chi_squared_at(
+            phe, noise, interpolate_response(te_grid, response, te)
+        )
+
+    ratio = (np.sqrt(5) - 1) / 2
+    width = np.max(right - left, initial=0)
+    iterations = 0
+    if width > te_tolerance:
+        iterations = int(np.ceil(np.log(te_tolerance / width) / np.log(ratio)))
+
+    te_1 = right - ratio * (right - left)
+    te_2 = left + ratio * (right - left)
+    chi_1, chi_2 = chi_squared(te_1), chi_squared(te_2)
+    for _ in range(iterations):
+        go_left = chi_1 < chi_2
+        right = np.where(go_left, te_2, right)
+        left = np.where(go_left, left, te_1)
+        te_1, te_2 = (
+            np.where(go_left, right - ratio * (right - left), te_2),
+            np.where(go_left, te_1, left + ratio * (right - left)),
+        )
+        te_new = np.where(go_left, te_1, te_2)
+        chi_new = chi_squared(te_new)
+        chi_1, chi_2 = (
+            np.where(go_left, chi_new, chi_2),
+            np.where(go_left, chi_1, chi_new),
+        )
+
+    te = (left + right) / 2
+    # золотое сечение не хуже точки сетки
+    te_node = te_grid[te_ind]
+    return np.where(chi_squared(te) <= chi_squared(te_node), te, te_node)
+
+
+ERROR_OK = 0
+ERROR_GRID_EDGE = 1
+ERROR_SINGULAR = 2
+ERROR_NO_DENSITY = 3
+
+
+def get_fisher_errors(
+    noise: np.ndarray,
+    expected: np.ndarray,
+    expected_derivative: np.ndarray,
+    density: np.ndarray,
+    full_coef: float | np.ndarray,
+) -> (np.ndarray, np.ndarray, np.ndarray):
+    """
+    Ошибки Te и ne из матрицы Фишера для всех выстрелов сразу
+    :param noise: шум фотоэлектронов (..., ch)
+    :param expected: ожидаемые сигналы при найденной Te (..., ch)
+    :param expected_derivative: dfe/dTe при найденной Te (..., ch)
+    :param density: ne (...)
+    :param full_coef: перевод ne * fe в фотоэлектроны, число или (fiber, 1)
+    :return: ошибка Te (...), ошибка ne (...), флаги ERROR_* (...)
+    """
+    weight = 1 / np.asarray(noise, dtype=float) ** 2
+
+    sum_fe_to_noise = np.sum(expected**2 * weight, axis=-1)
+    sum_derivative_fe_to_noise = np.sum(expected_derivative**2 * weight, axis=-1)
+    sum_fe_derivative_fe_to_noise = (
+        np.sum(expected_derivative * expected * weight, axis=-1) ** 2
+    )
+    determinant = (
+        sum_fe_to_noise * sum_derivative_fe_to_noise - sum_fe_derivative_fe_to_noise
+    )
+
+    flags = np.full(determinant.shape, ERROR_OK)
+    flags[~np.isfinite(density) | (density == 0)] = ERROR_NO_DENSITY
+    flags[~(determinant > 0) | ~np.isfinite(determinant)] = ERROR_SINGULAR
+    flags[np.any(~np.isfinite(expected_derivative), axis=-1)] = ERROR_GRID_EDGE
+
+    ok = flags == ERROR_OK
+    determinant = np.where(ok, determinant, 1)
+    density = np.where(ok, density, 1)
+
+    te_err = np.sqrt(sum_fe_to_noise / determinant) / np.abs(density * full_coef)
+    ne_err = np.sqrt(sum_derivative_fe_to_noise / determinant) / np.abs(full_coef)
+    return np.where(ok, te_err, np.nan), np.where(ok, ne_err, np.nan), flags
+
+
+def fit_temperature_samples(
+    samples: np.ndarray, noise: np.ndarray, response: np.ndarray
+) -> np.ndarray:
+    """
+    Перебор сетки Te для многих реализаций одних и тех же выстрелов.
+    Шум у реализаций общий, поэтому sum_2 считается один раз на выстрел,
+    а минимум chi^2 ищется как максимум |sum_1| / sqrt(sum_2)
+    :param samples: фотоэлектроны (realizations, shots, ch)
+    :param noise: шум фотоэлектронов (shots, ch)
+    :param response: ожидаемые сигналы с учетом спектральной калибровки (Te, ch)
+    :return: индексы Te (realizations, shots)
+    """
+    weight = 1 / np.asarray(noise, dtype=float) ** 2
+    sum_2 = weight @ (response**2).T
+    # (shots, ch, Te)
+    normalized = response.T[None] * weight[..., None] / np.sqrt(sum_2)[:, None, :]
+    sum_1 = np.matmul(np.swapaxes(samples, 0, 1), normalized)
+    return np.argmax(np.abs(sum_1), axis=-1).T
+
+
+def monte_carlo_chunk(args) -> (np.ndarray, np.ndarray):
+    """
+    Пачка реализаций Монте-Карло, функция для пула процессов.
+    phe разыгрываются нормально с шумом из get_signal_integrals, для каждой
+    реализации заново ищется Te и амплитуда (ne без перевода в м^-3)
+    :param args: (phe (shots, ch), noise (shots, ch), te_grid, response (Te, ch),
+        seed - SeedSequence пачки, realizations - число реализаций, refine)
+    :return: Te и амплитуды (realizations, shots)
+    """
+    phe, noise, te_grid, response, seed, realizations, refine = args
+    rng = np.random.default_rng(seed)
+    samples = phe + noise * rng.standard_normal((realizations,) + phe.shape)
+
+    te_ind = fit_temperature_samples(samples, noise, response)
+    if refine:
+        te = refine_temperature(samples, noise, te_grid, response, te_ind)
+        expected = interpolate_response(te_grid, response, te)
+    else:
+        te = te_grid[te_ind]
+        expected = response[te_ind]
+
+    weight = 1 / noise**2
+    amplitude = np.sum(samples * expected * weight, axis=-1) / np.sum(
+        expected**2 * weight, axis=-1
+    )
+    return te, amplitude
+
+
+class RatioIndex:
+    """
+    Быстрая оценка Te по отношениям каналов. Строки отклика нормируются
+    на единичную длину, так что ne сокращается и остаются только отношения.
+    Точки идут вдоль кривой Te и режутся на блоки соседних Te, для блока
+    хранится ограничивающий прямоугольник. Запрос просматривает блоки по
+    возрастанию расстояния до прямоугольника и останавливается, когда оно
+    не меньше лучшего найденного: ближайшая точка находится точно, а
+    просматривается обычно несколько блоков
+    """
+
+    def __init__(self, response: np.ndarray, block_size: int = 64):
+        """
+        :param response: ожидаемые сигналы с учетом спектральной калибровки (Te, ch)
+        :param block_size: число соседних точек сетки Te в блоке
+        """
+        response = np.asarray(response, dtype=float)
+        norm = np.linalg.norm(response, axis=-1)
+        self.te_ind = np.flatnonzero(norm > 0)
+        points = response[self.te_ind] / norm[self.te_ind, None]
+        self.block_size = block_size
+
+        starts = np.arange(0, len(points), block_size)
+        self.lower = np.minimum.reduceat(points, starts, axis=0)
+        self.upper = np.maximum.reduceat(points, starts, axis=0)
+
+        # последний блок дополняется бесконечно далекими точками
+        self.block_points = np.full((starts.size * block_size, points.shape[1]), np.inf)
+        self.block_points[: len(points)] = points
+        self.block_points = self.block_points.reshape(
+            starts.size, block_size, points.shape[1]
+        )
+
+    def query(self, phe: np.ndarray) -> np.ndarray:
+        """
+        :param phe: фотоэлектроны (..., ch)
+        :return: индексы точек сетки Te с ближайшими отношениями каналов (...)
+        """
+        phe = np.asarray(phe, dtype=float)
+        points = phe.reshape(-1, phe.shape[-1])
+        points = points / np.linalg.norm(points, axis=-1, keepdims=True)
+
+        # (queries, blocks) квадрат расстояния до прямоугольника блока
+        bound = np.zeros((len(points), len(self.lower)))
+        for ch in range(points.shape[1]):
+            gap = np.maximum(self.lower[:, ch] - points[:, ch, None], 0) + np.maximum(
+                points[:, ch, None] - self.upper[:, ch], 0
+            )
+            bound += gap**2
+        order = np.argsort(bound, axis=-1)
+
+        best_dist = np.full(len(points), np.inf)
+        best = np.zeros(len(points), dtype=int)
+        queries = np.arange(len(points))
+        for step in range(len(self.lower)):
+            block = order[queries, step]
+            active = bound[queries, block] < best_dist[queries]
+            queries, block = queries[active], block[active]
+            if not queries.size:
+                break
+            dist = np.sum(
+                (self.block_points[block] - points[queries, None]) ** 2, axis=-1
+            )
+            ind = np.argmin(dist, axis=-1)
+            dist = dist[np.arange(queries.size), ind]
+            better = dist < best_dist[queries]
+            best_dist[queries[better]] = dist[better]
+            best[queries[better]] = block[better] * self.block_size + ind[better]
+        return self.te_ind[best].reshape(phe.shape[:-1])
+
+
+def fit_temperature_window(
+    phe: np.ndarray,
+    noise: np.ndarray,
+    response: np.ndarray,
+    center_ind: np.ndarray,
+    half_width: int,
+) -> (np.ndarray, np.ndarray):
+    """
+    Перебор сетки Te только в окне вокруг начального приближения
+    :param phe: фотоэлектроны (shots, ch)
+    :param noise: шум фотоэлектронов (shots, ch)
+    :param response: ожидаемые сигналы с учетом спектральной калибровки (Te, ch)
+    :param center_ind: начальные индексы Te (shots)
+    :param half_width: полуширина окна в точках сетки
+    :return: индексы Te с минимальным chi^2 (shots), сам минимум (shots)
+        и признак минимума на краю окна (shots)
+    """
+    te_number = response.shape[0]
+    width = min(2 * half_width + 1, te_number)
+    start = np.clip(np.asarray(center_ind) - half_width, 0, te_number - width)
+    window_ind = start[:, None] + np.arange(width)
+
+    chi = get_chi_squared_at(
+        np.asarray(phe, dtype=float)[:, None],
+        np.asarray(noise, dtype=float)[:, None],
+        response[window_ind],
+    )
+    best = np.argmin(chi, axis=-1)
+    te_ind = np.take_along_axis(window_ind, best[:, None], axis=-1)[:, 0]
+    chi_min = np.take_along_axis(chi, best[:, None], axis=-1)[:, 0]
+    on_edge = ((best == 0) & (start > 0)) | (
+        (best == width - 1) & (start + width < te_number)
+    )
+    return te_ind, chi_min, on_edge
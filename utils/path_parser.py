@@ -25,6 +25,7 @@ def read_config(config_path: Path):
     path_T15_f_exp = config.get("path_T15_f_exp", "path")
 
     config_connection = config.get("poly_fiber_caen_connection", "path")
+    scattering_angles = config.get("scattering_angles", "path", fallback=None)
     save_data = config.get("save_data_path", "path")
 
     config_data = {
@@ -43,6 +44,7 @@ def read_config(config_path: Path):
         "path_eq_f_exp": Path(path_eq_f_exp),
         "path_T15_f_exp": Path(path_T15_f_exp),
         "poly_fiber_caen_connection": Path(config_connection),
+        "scattering_angles": Path(scattering_angles) if scattering_angles else None,
         "save_data_path": Path(save_data),
     }
 
@@ -0,0 +1,196 @@
+import numpy as np
+
+
+def get_window_borders(config: list[dict]) -> np.ndarray:
+    """
+    Границы окон интегрирования каналов в нс
+    :param config: конфиг каналов полихроматора с sig_LeftBord, sig_RightBord
+    :return: (ch, 2)
+    """
+    return np.array(
+        [
+            [ch_config["sig_LeftBord"], ch_config["sig_RightBord"]]
+            for ch_config in config
+        ],
+        dtype=float,
+    )
+
+
+def get_signal_windows(
+    signals_time, config: list[dict]
+) -> (np.ndarray, np.ndarray, np.ndarray):
+    """
+    Окна интегрирования каналов полихроматора для всех выстрелов
+    :param signals_time: CaenTimeBase выстрелов
+    :param config: конфиг каналов полихроматора с sig_LeftBord, sig_RightBord
+    :return: индексы начала и конца окна (shots, ch) и границы окна в нс (ch, 2)
+    """
+    borders = get_window_borders(config)
+    left_ind, right_ind = zip(
+        *(signals_time.window_indices(left, right) for left, right in borders)
+    )
+    return np.stack(left_ind, axis=1), np.stack(right_ind, axis=1), borders
+
+
+def get_noise_statistics(
+    waveforms: np.ndarray, noise_len: int = 400, waveform_index=None
+) -> (np.ndarray, np.ndarray):
+    """
+    Уровень над нулем (медиана) и шум (несмещенное СКО) участка до сигнала
+    :param waveforms: сигналы (..., 1024)
+    :param noise_len: длина участка до сигнала в отсчетах
+    :param waveform_index: WaveformIndex тех же сигналов, шум берется из него за O(1)
+    :return: два массива (...)
+    """
+    noise_part = np.asarray(waveforms[..., :noise_len], dtype=float)
+    if waveform_index is None:
+        signal_std = np.std(noise_part, axis=-1, ddof=1)
+    else:
+        signal_std = np.sqrt(waveform_index.window_variance(0, noise_len))
+    return np.median(noise_part, axis=-1), signal_std
+
+
+def get_window_sums(
+    waveforms: np.ndarray, left_ind: np.ndarray, right_ind: np.ndarray
+) -> np.ndarray:
+    """
+    Суммы отсчетов в окнах [left_ind, right_ind)
+    :param waveforms: сигналы (..., 1024)
+    :param left_ind: начало окна (...)
+    :param right_ind: конец окна (...)
+    :return: (...)
+    """
+    counts = np.arange(waveforms.shape[-1])
+    window = (counts >= left_ind[..., None]) & (counts < right_ind[..., None])
+    return np.sum(waveforms, axis=-1, where=window)
+
+
+class WaveformIndex:
+    """
+    Индекс накопленных сумм сигналов и их квадратов по последней оси:
+    сумма, среднее и дисперсия любого окна [left, right) считаются за O(1).
+    Сигналы сдвигаются на первый отсчет трассы, чтобы сумма квадратов
+    не теряла точность на большом уровне над нулем
+    """
+
+    def __init__(self, waveforms: np.ndarray = None):
+        if waveforms is None:
+            return
+        waveforms = np.asarray(waveforms, dtype=float)
+        self.offset = waveforms[..., 0].copy()
+        shifted = waveforms - self.offset[..., None]
+
+        shape = waveforms.shape[:-1] + (waveforms.shape[-1] + 1,)
+        self.cumsum = np.zeros(shape)
+        self.cumsum_sq = np.zeros(shape)
+        np.cumsum(shifted, axis=-1, out=self.cumsum[..., 1:])
+        np.cumsum(shifted**2, axis=-1, out=self.cumsum_sq[..., 1:])
+
+    @classmethod
+    def from_arrays(cls, offset, cumsum, cumsum_sq):
+        index = cls()
+        index.offset, index.cumsum, index.cumsum_sq = offset, cumsum, cumsum_sq
+        return index
+
+    @classmethod
+    def stack(cls, indices: list["WaveformIndex"]) -> "WaveformIndex":
+        """
+        Объединение индексов одинаковой формы по новой первой оси, например волокон
+        """
+        return cls.from_arrays(
+            np.stack([index.offset for index in indices]),
+            np.stack([index.cumsum for index in indices]),
+            np.stack([index.cumsum_sq for index in indices]),
+        )
+
+    def __getitem__(self, key) -> "WaveformIndex":
+        """
+        Срез по передним осям (выстрелы, каналы), ось отсчетов сохраняется
+        """
+        return WaveformIndex.from_arrays(
+            self.offset[key], self.cumsum[key], self.cumsum_sq[key]
+        )
+
+    @property
+    def samples_number(self) -> int:
+        return self.cumsum.shape[-1] - 1
+
+    def _window(self, cumsum, left, right) -> np.ndarray:
+        shape = np.broadcast_shapes(cumsum.shape[:-1], np.shape(left), np.shape(right))
+        cumsum = np.broadcast_to(cumsum, shape + cumsum.shape[-1:])
+        left = np.broadcast_to(left, shape)[..., None]
+        right = np.broadcast_to(right, shape)[..., None]
+        return (
+            np.take_along_axis(cumsum, right, axis=-1)
+            - np.take_along_axis(cumsum, left, axis=-1)
+        )[..., 0]
+
+    def window_sum(self, left, right) -> np.ndarray:
+        """
+        Сумма отсчетов в окне [left, right), left и right - индексы или массивы индексов
+        """
+        return self._window(self.cumsum, left, right) + self.offset * (
+            np.asarray(right) - np.asarray(left)
+        )
+
+    def window_mean(self, left, right) -> np.ndarray:
+        return self.window_sum(left, right) / (np.asarray(right) - np.asarray(left))
+
+    def window_variance(self, left, right, ddof: int = 1) -> np.ndarray:
+        """
+        Дисперсия отсчетов в окне [left, right), по умолчанию несмещенная, как statistics.variance
+        """
+        count = np.asarray(right) - np.asarray(left)
+        shifted_sum = self._window(self.cumsum, left, right)
+        shifted_sum_sq = self._window(self.cumsum_sq, left, right)
+        variance = (shifted_sum_sq - shifted_sum**2 / count) / (count - ddof)
+        return np.maximum(variance, 0)
+
+
+def integrate_signals(
+    waveforms: np.ndarray,
+    left_ind: np.ndarray,
+    right_ind: np.ndarray,
+    borders: np.ndarray,
+    all_const: float,
+    t_step: float = 0.325,
+    noise_len: int = 400,
+    excess_noise_factor: float = 3,
+    waveform_index: WaveformIndex = None,
+    noise_statistics: tuple[np.ndarray, np.ndarray] = None,
+) -> (np.ndarray, np.ndarray):
+    """
+    Число фотоэлектронов и шум для всех выстрелов и каналов за один проход.
+    Впереди могут быть дополнительные оси, например волокна: (fiber, shots, ch, 1024)
+    :param waveforms: сигналы (..., shots, ch, 1024), не нужны (None),
+        если заданы waveform_index и noise_statistics
+    :param left_ind: начало окна интегрирования в отсчетах (..., shots, ch)
+    :param right_ind: конец окна интегрирования в отсчетах (..., shots, ch)
+    :param borders: границы окна в нс, (ch, 2) или (..., 1, ch, 2)
+    :param all_const: перевод мВ * нс в фотоэлектроны, число или (..., 1, 1)
+    :param t_step: шаг оцифровщика
+    :param noise_len: длина участка до сигнала для уровня над нулем и шума
+    :param excess_noise_factor: фактор избыточного шума лавинного диода
+    :param waveform_index: WaveformIndex тех же сигналов для сумм по окнам
+    :param noise_statistics: готовые (уровень, шум) из get_noise_statistics
+    :return: phe (..., shots, ch), шум phe (..., shots, ch)
+    """
+    if noise_statistics is None:
+        noise_statistics = get_noise_statistics(waveforms, noise_len, waveform_index)
+    signal_lvl, signal_std = noise_statistics
+
+    if waveform_index is None:
+        window_sum = get_window_sums(
+            np.asarray(waveforms, dtype=float), left_ind, right_ind
+        )
+    else:
+        window_sum = waveform_index.window_sum(left_ind, right_ind)
+
+    lvl_integral = signal_lvl * (borders[..., 1] - borders[..., 0])
+    phe = (window_sum * t_step - lvl_integral) * all_const
+
+    noise_track = (signal_std * all_const * t_step * (right_ind - left_ind)) ** 2
+    noise_excess = np.where(phe > 0, phe * excess_noise_factor, 0)
+    phe = np.where(phe > 0, phe, 1)
+
+    return phe, np.sqrt(noise_track + noise_excess)
@@ -2,9 +2,18 @@ import os
 from itertools import zip_longest
 from pathlib import Path
 
+import numpy as np
+
 from utils.POLY_v2 import Polychromator
 
 
+def format_error(error: float, valid: bool) -> str:
+    """
+    Ошибка для csv, для невалидных выстрелов пишется 0
+    """
+    return f"{error}" if valid else "0"
+
+
 def write_results(
         discharge_num: str, path, laser_shots_times: list, fibers: list[Polychromator]
 ):
@@ -22,11 +31,13 @@ def write_results(
                 + ", error\n"
             )
             for fiber in fibers:
+                results = fiber.results
                 result_string = [
-                    f"{t_e}, {te_err}"
-                    for t_e, te_err in zip(
-                        fiber.temperatures[from_shot:to_shot],
-                        fiber.errors_T[from_shot:to_shot],
+                    f"{t_e}, {format_error(te_err, valid)}"
+                    for t_e, te_err, valid in zip(
+                        results.te[from_shot:to_shot].tolist(),
+                        results.te_err[from_shot:to_shot].tolist(),
+                        results.valid[from_shot:to_shot],
                     )
                 ]
                 temperature_file.write(
@@ -42,22 +53,68 @@ def write_results(
                 + ", error\n"
             )
             for fiber in fibers:
+                results = fiber.results
                 result_string = [
-                    f"{n_e}, {ne_err}"
-                    for n_e, ne_err in zip(
-                        fiber.density[from_shot:to_shot],
-                        fiber.errors_n[from_shot:to_shot],
+                    f"{n_e}, {format_error(ne_err, valid)}"
+                    for n_e, ne_err, valid in zip(
+                        results.ne[from_shot:to_shot].tolist(),
+                        results.ne_err[from_shot:to_shot].tolist(),
+                        results.valid[from_shot:to_shot],
                     )
                 ]
                 density_file.write(
                     f"{str(fiber.z_cm)}, " + ", ".join(result_string) + "\n"
                 )
 
+        for name, interval in (("Te", "te_interval"), ("ne", "ne_interval")):
+            write_intervals(
+                rf"{path_to_write}\{discharge_num}_{name}_interval.csv",
+                laser_shots_times,
+                fibers,
+                interval,
+            )
+
     except Exception as e:
         print(f"Error in write_results: {e}")
         pass
 
 
+def write_intervals(
+        filename: str,
+        laser_shots_times: list[str],
+        fibers: list[Polychromator],
+        interval: str,
+        from_shot: int = 3,
+        to_shot: int = 20,
+) -> None:
+    """
+    Интервалы Монте-Карло (нижняя и верхняя границы) в csv рядом с Te и ne,
+    файл пишется, только если get_fibers_monte_carlo считался
+    :param interval: "te_interval" или "ne_interval" из FiberResults
+    """
+    if not any(
+            np.isfinite(getattr(fiber.results, interval)).any() for fiber in fibers
+    ):
+        return
+
+    with open(filename, "w") as interval_file:
+        interval_file.write(
+            "Z(cm), "
+            + ", high, ".join(laser_shots_times[from_shot:to_shot])
+            + ", high\n"
+        )
+        for fiber in fibers:
+            result_string = [
+                f"{low}, {high}"
+                for low, high in getattr(fiber.results, interval)[
+                    from_shot:to_shot
+                ].tolist()
+            ]
+            interval_file.write(
+                f"{str(fiber.z_cm)}, " + ", ".join(result_string) + "\n"
+            )
+
+
 def write_separatrix(
         filepath: Path, sht_num: int, timestamp: float, sep_data: dict
 ) -> None: